@@ -0,0 +1,44 @@
+import os
+import argparse
+import random
+import timeit
+
+# add xmt to the path
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmt.recipes.static.processor import INDEX_BACKENDS
+
+OPERATIONS = {
+    'and': lambda a, b: a & b,
+    'or': lambda a, b: a | b,
+    'sub': lambda a, b: a - b,
+    'invert': lambda a, b: ~a,
+    'len': lambda a, b: len(a),
+    'iter': lambda a, b: sum(1 for _ in a),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the IndexCollection backends.')
+    parser.add_argument('-n', '--size', type=int, default=200_000, help='Total number of lines')
+    parser.add_argument('-d', '--density', type=float, default=0.3, help='Fraction of lines in each tag')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    a = sorted(rng.sample(range(1, args.size + 1), int(args.size * args.density)))
+    b = sorted(rng.sample(range(1, args.size + 1), int(args.size * args.density)))
+
+    print(f'{args.size} lines, {len(a)} indices per tag (best of {args.repeat}, ms)')
+    print(f'{"op":<8}' + ''.join(f'{name:>10}' for name in INDEX_BACKENDS))
+    collections = {name: (cls(a, args.size, 'a'), cls(b, args.size, 'b'))
+                   for name, cls in INDEX_BACKENDS.items()}
+    for op, func in OPERATIONS.items():
+        row = f'{op:<8}'
+        for name, (x, y) in collections.items():
+            best = min(timeit.repeat(lambda: func(x, y), number=1, repeat=args.repeat))
+            row += f'{best * 1000:>10.2f}'
+        print(row)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import argparse
+import timeit
+
+# add xmt to the path
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jsonpath_ng import parse as parse_jsonpath
+from xmt.recipes.dynamic.processor import compile_jsonpath
+
+DOCUMENT = [{'data': {'children': [{'data': {'title': f'post {i}', 'score': i}} for i in range(25)]}}]
+PATHS = [
+    '$[0].data.children[0].data.title',
+    "$[0]['data'].children[-1].data.score",
+    '$[0].data.children[*].data.title',
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare JSONPath evaluation with and without the compiled cache.')
+    parser.add_argument('-n', '--number', type=int, default=200, help='Queries per timing')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+
+    print(f'{args.number} queries (best of {args.repeat}, ms)')
+    print(f'{"path":<40}{"parse":>10}{"cached":>10}{"speedup":>10}')
+    for path in PATHS:
+        def uncached(): return [m.value for m in parse_jsonpath(path).find(DOCUMENT)]
+        def cached(): return compile_jsonpath(path)(DOCUMENT)
+        assert uncached() == cached()
+        times = [min(timeit.repeat(func, number=args.number, repeat=args.repeat)) for func in (uncached, cached)]
+        print(f'{path:<40}{times[0] * 1000:>10.2f}{times[1] * 1000:>10.2f}{times[0] / times[1]:>9.0f}x')
+
+if __name__ == "__main__":
+    main()
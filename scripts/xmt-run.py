@@ -7,6 +7,7 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from xmt.recipes.utils import bootstrap
+from xmt.recipes.static import StaticRecipe
 from xmt.recipes.storage import FileStorage
 
 def main():
@@ -15,31 +16,42 @@ def main():
     parser.add_argument('-v', '--variable', type=str, default='', help=\
                         'Variable to return. If not specified, return the result (if dynamic) or content (if static)'
                         'of the recipe. If the value is *, return the entire diff.')
+    parser.add_argument('-c', '--compile', action='store_true', help=\
+                        'Static recipes only: save the executed recipe in compiled form next to its source, '
+                        'so later runs load it instead of executing it again.')
     args = parser.parse_args()
 
     recipe_path = args.recipe_path
     var = args.variable
 
     storage = FileStorage([os.path.dirname(recipe_path)])
-    recipe_spec = storage.load_recipe(os.path.basename(recipe_path))
+    name = os.path.basename(recipe_path)
 
-    recipe = bootstrap(recipe_spec, storage)
+    # compiled static recipes are loaded as they are, without touching the YAML
+    recipe = StaticRecipe.load_artifact(name, storage)
+    if recipe is None:
+        recipe = bootstrap(storage.load_recipe(name), storage)
     if recipe.type == 'dynamic':
 
-        diff, result = recipe.execute()
-        if not var: print(result)
-        elif var == '*': print(json.dumps(diff))
+        if not var or var == '*':
+            diff, result = recipe.execute()
+            print(result if not var else json.dumps(diff))
         else:
-            try: print(diff[var])
+            try:    # computes the variable, and only what it depends on
+                diff, result = recipe.execute(targets = [var])
+                print(diff[var])
             except KeyError:
                 print(f'Variable {var} not found in diff.', file=sys.stderr)
 
     elif recipe.type == 'static':
-        recipe.execute(compile_tags = True)
+        if recipe.tags is None:     # not loaded from the compiled form
+            recipe.execute(compile_tags = True)
+        if args.compile:
+            recipe.save(storage.artifact_path(name))
         if not var:
             print('\n'.join([p['content'] for p in recipe.content]))
         elif var == '*':
-            print(json.dumps(recipe.content))
+            print(json.dumps(recipe.content.to_records()))
         else:
             try: 
                 # check wheter var is an index
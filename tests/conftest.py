@@ -1,4 +1,7 @@
+import threading
+import time
 from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pytest
 
 from xmt.recipes.storage import MemoryStorage, FileStorage
@@ -47,4 +50,48 @@ def sta(fs):
     }
     sta_env.load_resource = fs.load_resource
 
-    return deepcopy(StaticRecipe(sta_env['basic'], sta_env))
\ No newline at end of file
+    return deepcopy(StaticRecipe(sta_env['basic'], sta_env))
+
+class StubServer(ThreadingHTTPServer):
+    ''' A local HTTP server for http sources. routes maps a path to a list of
+    (status, body, headers, delay) responses, served in turn (the last one repeats). '''
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.routes = {}
+        self.log = []       # (method, path, client port, request headers)
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_port}{path}'
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'      # keep-alive
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.server.log.append((self.command, self.path, self.client_address[1], dict(self.headers)))
+        responses = self.server.routes.get(self.path, [(404, '', {}, 0)])
+        status, body, headers, delay = responses.pop(0) if len(responses) > 1 else responses[0]
+        time.sleep(delay)
+        body = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.send_response(status)
+        for name, value in {'Content-Type': 'application/json', **headers}.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args): pass
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -1,7 +1,16 @@
+import os
+import json
+import time
+import threading
 from copy import deepcopy
 import pytest
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
 from ..xmt.recipes.dynamic import processor
+from ..xmt.recipes.dynamic.transport import Transport, ResponseCache
 class TestInclude:
     def test_cyclic_dependency(self, dyn):
         dyn.spec['include'].append({'dynamic': 'basic'})
@@ -129,3 +138,582 @@ class TestExpr:
 
         assert dyn['x'] == 1
     
+
+
+class TestParallel:
+    @pytest.fixture
+    def feeds(self, dyn, monkeypatch):
+        dyn.barrier = None      # when set, every fetch waits for the others to be under way
+        def remote(http, *args):
+            if dyn.barrier is not None:
+                dyn.barrier.wait(timeout=5)
+            return json.dumps({'feed': http['target']}), 'json'
+        monkeypatch.setattr('xmt.recipes.dynamic.processor.load_remote', remote)
+        dyn.spec['var'].extend([
+            {'base': 'http://feeds'},
+            {'a': {'http': '{{ base }}/a', 'do': 'jsonpath', 'return': '$.feed'}},
+            {'b': {'http': '{{ base }}/b', 'do': 'jsonpath', 'return': '$.feed'}},
+            {'c': {'http': '{{ base }}/c', 'do': 'jsonpath', 'return': '$.feed'}},
+            {'summary': '{{ a }}, {{ b }}, {{ c }}'},
+        ])
+        return dyn
+
+    def test_graph(self, feeds):
+        feeds.execute(total=True)
+        graph = feeds.dependency_graph()
+        names = [tuple(defn)[0] for defn in feeds.spec['var']]
+        deps = {names[pos]: {names[dep] for dep in graph[pos]} for pos in range(len(names))}
+        assert deps['a'] == deps['b'] == {'base'}
+        assert deps['summary'] == {'a', 'b', 'c'}
+
+    def test_concurrent(self, feeds):
+        feeds.barrier = threading.Barrier(3)       # broken, after the timeout, unless a, b and c overlap
+        feeds.execute(total=True, workers=4)
+        assert not feeds.barrier.broken
+        feeds.barrier = None
+        assert feeds['summary'] == 'http://feeds/a, http://feeds/b, http://feeds/c'
+
+        sequential = deepcopy(feeds)
+        sequential.execute(total=True)
+        assert list(sequential.diff.items()) == list(feeds.diff.items())
+
+
+class TestTransport:
+    def test_keep_alive(self, stub):
+        stub.routes['/x'] = [(200, '{"a": 1}', {}, 0)]
+        with Transport() as transport:
+            for _ in range(3):
+                assert processor.load_remote({'target': stub.url('/x'), 'type': 'auto'}, transport) == ('{"a": 1}', 'json')
+        assert len({port for _, _, port, _ in stub.log}) == 1       # one connection
+
+    def test_retry(self, stub):
+        stub.routes['/flaky'] = [(503, '', {}, 0), (503, '', {}, 0), (200, '"ok"', {}, 0)]
+        with Transport(backoff=0) as transport:
+            assert transport.request('GET', stub.url('/flaky')).json() == 'ok'
+        assert len(stub.log) == 3
+
+    def test_timeout(self, stub):
+        stub.routes['/slow'] = [(200, '{}', {}, 0.5)]
+        start = time.perf_counter()
+        with Transport(retries=0) as transport:
+            with pytest.raises(requests.exceptions.RequestException, match='timed out'):
+                processor.load_remote({'target': stub.url('/slow'), 'type': 'auto', 'timeout': 0.1}, transport)
+        assert time.perf_counter() - start < 0.4
+
+    def test_async(self, stub):
+        stub.routes['/x'] = [(200, '[1]', {}, 0.2)]
+
+        async def fetch_all():
+            return await asyncio.gather(*[
+                processor.aload_remote({'target': stub.url('/x'), 'type': 'auto'}) for _ in range(4)])
+
+        start = time.perf_counter()
+        assert asyncio.run(fetch_all()) == [('[1]', 'json')] * 4
+        assert time.perf_counter() - start < 0.6
+
+    def test_recipe(self, dyn, stub):
+        stub.routes['/todo'] = [(200, '{"title": "t"}', {}, 0)]
+        dyn.env.transport = Transport()
+        dyn.spec['var'].append({'x': {'http': stub.url('/todo'), 'do': 'jsonpath', 'return': '$.title'}})
+        dyn.execute(total=True)
+        assert dyn['x'] == 't'
+
+
+class TestResponseCache:
+    @pytest.fixture
+    def cached(self, dyn, stub, tmp_path):
+        dyn.env.http_cache = ResponseCache(str(tmp_path))
+        dyn.spec['var'].append({'x': {'http': stub.url('/quote'), 'cache': {'ttl': 60},
+                                      'do': 'jsonpath', 'return': '$.q'}})
+        return dyn
+
+    def test_ttl(self, cached, stub):
+        stub.routes['/quote'] = [(200, '{"q": "first"}', {}, 0), (200, '{"q": "second"}', {}, 0)]
+        cached.execute(total=True)
+        cached.execute(total=True)
+        assert cached['x'] == 'first' and len(stub.log) == 1
+        assert cached.env.http_cache.stats()['hits'] == 1
+
+    def test_revalidation(self, cached, stub):
+        stub.routes['/quote'] = [(200, '{"q": "first"}', {'ETag': '"v1"'}, 0), (304, '', {}, 0)]
+        cached.spec['var'][-1]['x']['cache'] = 0      # always stale
+        cached.execute(total=True)
+        cached.execute(total=True)
+        assert cached['x'] == 'first'
+        assert stub.log[1][3]['If-None-Match'] == '"v1"'
+        assert cached.env.http_cache.stats()['revalidations'] == 1
+
+    def test_credentials(self, cached, stub, tmp_path):
+        stub.routes['/quote'] = [(200, '{"q": "first"}', {}, 0), (200, '{"q": "second"}', {}, 0)]
+        cached.spec['var'][-1]['x']['http'] = {'target': stub.url('/quote'), 'headers': {'Authorization': 'Bearer t'}}
+        cached.execute(total=True)
+        assert cached.env.http_cache.stats()['entries'] == 0
+        cached.spec['var'][-1]['x']['cache'] = {'ttl': 60, 'private': True}
+        cached.execute(total=True)
+        cached.execute(total=True)
+        assert cached['x'] == 'second' and len(stub.log) == 2
+        assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+        assert all(os.stat(tmp_path / name).st_mode & 0o077 == 0 for name in os.listdir(tmp_path))
+
+    def test_set_cookie(self, cached, stub):
+        stub.routes['/quote'] = [(200, '{"q": "first"}', {'Set-Cookie': 'session=1'}, 0)]
+        cached.execute(total=True)
+        assert cached['x'] == 'first' and cached.env.http_cache.stats()['entries'] == 0
+
+    def test_eviction(self, tmp_path):
+        cache = ResponseCache(str(tmp_path), max_bytes=10)
+        cache.put('a', b'123456')
+        cache.put('b', b'123456')
+        assert cache.get('a') is None and cache.get('b')[1] == b'123456'
+        assert ResponseCache(str(tmp_path)).stats()['entries'] == 1     # persisted
+
+    def test_key(self):
+        assert ResponseCache.key('get', 'u', {'a': '1'}) == ResponseCache.key('GET', 'u', {'a': '1'})
+        assert ResponseCache.key('GET', 'u', {'a': '1'}) != ResponseCache.key('GET', 'u', {'a': '2'})
+        assert ResponseCache.key('POST', 'u', None, 'x') != ResponseCache.key('POST', 'u', None, 'y')
+
+
+class TestCoalescing:
+    def test_singleflight(self, stub):
+        stub.routes['/x'] = [(200, '[1]', {}, 0.2)]
+        flight = processor.SingleFlight()
+        with Transport() as transport, ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda _: processor.load_remote(
+                {'target': stub.url('/x'), 'type': 'auto'}, transport, singleflight=flight), range(4)))
+        assert results == [('[1]', 'json')] * 4
+        assert len(stub.log) == 1 and flight.shared == 3
+
+    def test_errors_shared(self):
+        flight = processor.SingleFlight()
+        def fail():
+            time.sleep(0.1)
+            raise ValueError('boom')
+        with ThreadPoolExecutor(2) as pool:
+            futures = [pool.submit(flight.do, 'k', fail) for _ in range(2)]
+        for future in futures:
+            with pytest.raises(ValueError, match='boom'):
+                future.result()
+        assert flight.do('k', lambda: 1) == 1      # nothing left in flight
+
+    def test_recipe(self, dyn, stub):
+        stub.routes['/x'] = [(200, '{"a": 1}', {}, 0.2)]
+        dyn.env.transport = Transport()
+        dyn.env.singleflight = processor.SingleFlight()
+        dyn.spec['var'].extend({name: {'http': stub.url('/x'), 'do': 'jsonpath', 'return': '$.a'}}
+                               for name in ('x', 'y', 'z'))
+        dyn.execute(total=True, workers=3)
+        assert (dyn['x'], dyn['y'], dyn['z']) == (1, 1, 1) and len(stub.log) == 1
+
+    def test_off_by_default(self, dyn, stub):
+        stub.routes['/random'] = [(200, f'{{"a": {i}}}', {}, 0.2) for i in range(3)]
+        dyn.env.transport = Transport()
+        dyn.spec['var'].extend({name: {'http': stub.url('/random'), 'do': 'jsonpath', 'return': '$.a'}}
+                               for name in ('x', 'y', 'z'))
+        dyn.execute(total=True, workers=3)
+        assert sorted((dyn['x'], dyn['y'], dyn['z'])) == [0, 1, 2] and len(stub.log) == 3
+
+    def test_keyed_by_type(self, stub):
+        stub.routes['/x'] = [(200, '[1]', {'Content-Type': 'text/plain'}, 0.2)]
+        flight = processor.SingleFlight()
+        with Transport() as transport, ThreadPoolExecutor(2) as pool:
+            results = list(pool.map(lambda type: processor.load_remote(
+                {'target': stub.url('/x'), 'type': type}, transport, singleflight=flight), ['yaml', 'raw']))
+        assert [type for _, type in results] == ['yaml', 'raw'] and flight.shared == 0
+
+    def test_rate_limit(self):
+        limiter = processor.RateLimiter(rate=20, burst=2, hosts={'fast': (1000, 1)})
+        start = time.perf_counter()
+        for _ in range(4):
+            limiter.acquire('slow')
+        assert 0.08 < time.perf_counter() - start < 0.3         # 2 free, then 2 at 50ms apart
+        start = time.perf_counter()
+        for _ in range(4):
+            limiter.acquire('fast')
+        assert time.perf_counter() - start < 0.05
+
+
+class TestTemplates:
+    def test_no_recompiles(self, dyn):
+        dyn.env.templates = processor.Templates()
+        dyn.spec['var'].extend([{'x': {'do': 'jinja2', 'return': '{{ 1 + 2 }}'}},
+                                {'y': {'do': 'jinja2', 'return': 'plain'}}])
+        dyn.execute(total=True)
+        compiles = dyn.env.templates.compiles
+        dyn.execute(total=True)
+        assert dyn.env.templates.compiles == compiles
+        assert (dyn['x'], dyn['y']) == ('3', 'plain')
+
+    def test_plain_strings(self):
+        templates = processor.Templates()
+        assert templates.render('no template\n', {}) == 'no template'
+        assert templates.render('{{ a }}', {'a': 1}) == '1'
+        assert templates.compiles == 1
+
+    def test_bounded(self):
+        templates = processor.Templates(size=2)
+        for source in ['{{ 1 }}', '{{ 2 }}', '{{ 3 }}', '{{ 1 }}']:
+            templates.render(source, {})
+        assert templates.compiles == 4
+
+    def test_bytecode(self, tmp_path):
+        processor.Templates(bytecode_dir=str(tmp_path)).render('{{ a }}', {'a': 1})
+        assert list(tmp_path.iterdir())
+        assert processor.Templates(bytecode_dir=str(tmp_path)).render('{{ a }}', {'a': 2}) == '2'
+
+    def test_native(self, dyn):
+        dyn.native = True
+        dyn.spec['var'].extend([{'xs': {'do': 'jinja2', 'return': '{{ [1, 2] + [3] }}'}},
+                                {'n': {'do': 'jinja2', 'return': '{{ xs | sum }}'}},
+                                {'s': {'do': 'jinja2', 'return': '{{ n }}', 'native': False}}])
+        dyn.execute(total=True)
+        assert (dyn['xs'], dyn['n'], dyn['s']) == ([1, 2, 3], 6, '6')
+
+    def test_native_payload(self):
+        http = {'target': 'http://x/{{ id }}', 'data': {'messages': '{{ msgs }}'}}
+        context = {'id': 7, 'msgs': [{'role': 'user'}]}
+        assert processor.interpret(http, context, native=True) == \
+            {'target': 'http://x/7', 'data': {'messages': [{'role': 'user'}]}}
+        assert processor.interpret(http, context)['data'] == {'messages': "[{'role': 'user'}]"}
+
+
+class TestJsonPath:
+    DOC = {'a': [{'b': 1}, {'b': 2}], 'c': {'d-e': 3}, 's': 'xyz'}
+
+    @pytest.mark.parametrize('path', ['$.a[0].b', '$.a[-1]', "$.c['d-e']", '$.c.d-e', '$.s[1]',
+                                      '$.a.b', '$.a[5]', '$.x.y', '$', '$.a[*].b', '$..b'])
+    def test_same_as_jsonpath_ng(self, path):
+        from jsonpath_ng import parse
+        assert processor.compile_jsonpath(path)(self.DOC) == [m.value for m in parse(path).find(self.DOC)]
+
+    def test_fast_path(self):
+        assert processor._simple_jsonpath('$[0].data.children[0].data.title') is not None
+        assert processor._simple_jsonpath('$.a[*]') is None and processor._simple_jsonpath('a.b') is None
+
+    def test_cached(self):
+        assert processor.compile_jsonpath('$..b') is processor.compile_jsonpath('$..b')
+        assert processor.jsonpath_query(self.DOC, '$..b') == [1, 2]
+        assert processor.jsonpath_query(self.DOC, '$.c.d-e') == 3
+
+
+class TestPlan:
+    def test_spec_untouched(self, dyn):
+        dyn.spec['var'].extend([{'x': 1}, {'y': {'path': 'testtext.txt'}}])
+        dyn.spec['result'] = '{{ x }}'
+        before = deepcopy(dyn.spec['var'])
+        for _ in range(3):
+            _, result = dyn.execute(total=True)
+        assert dyn.spec['var'] == before and result == '1'
+        assert [var.name for var in dyn.plan.vars] == ['x', 'y', 'RETURN']
+
+    def test_shared(self, dyn):
+        dyn.spec['var'].append({'x': '{{ 1 }}'})
+        dyn.execute(total=True)
+        other = deepcopy(dyn)
+        other.execute(total=True)
+        assert other.plan is dyn.plan
+        with pytest.raises(AttributeError):
+            dyn.plan.vars[0].name = 'y'
+
+    def test_results_unshared(self, dyn):
+        dyn.spec['var'].append({'x': {'return': {'a': [1]}}})
+        first, second = deepcopy(dyn), deepcopy(dyn)
+        first.execute(total=True)[0]['x']['a'].append(99)
+        assert second.execute(total=True)[0]['x'] == {'a': [1]}
+        assert first.plan is second.plan
+
+    def test_normalized(self):
+        from ..xmt.recipes.dynamic.parsing import compile_var
+        var = compile_var('x', {'http': 'http://h/{{ id }}', 'cache': 5})
+        assert (var.source, var.target, var.templated, var.ttl) == \
+            ('http', {'target': 'http://h/{{ id }}', 'type': 'auto'}, True, 5)
+        assert var.references == {'id'} and compile_var('x', {}) is None
+        with pytest.raises(Exception, match='more than one source'):
+            compile_var('x', {'http': 'a', 'path': 'b'})
+
+    def test_headers_untouched(self):
+        http = {'target': 'u', 'data': {'a': 1}}
+        processor._remote_request(http)
+        assert 'headers' not in http
+
+
+class TestBatch:
+    @pytest.fixture
+    def greet(self, dyn):
+        dyn.spec['var'].extend([{'name': 'nobody'}, {'greeting': 'hello {{ name }}'}])
+        dyn.spec['result'] = '{{ greeting }}!'
+        dyn.execute(total=True)
+        return dyn
+
+    def test_state_first(self, greet):
+        diff, result = greet.execute(total=True, state={'name': 'ann'})
+        assert diff['greeting'] == 'hello ann' and result == 'hello ann!'
+
+    @pytest.mark.parametrize('workers', [1, 4])
+    def test_execute_many(self, greet, workers):
+        states = ({'name': str(i)} for i in range(20))
+        results = [result for _, result in greet.execute_many(states, workers=workers)]
+        assert results == [f'hello {i}!' for i in range(20)]
+
+    def test_streams(self, greet):
+        def states():
+            yield {'name': 'a'}
+            raise RuntimeError('not read this far')
+        runs = greet.execute_many(states())
+        assert next(runs)[1] == 'hello a!'
+
+    def test_state_in_fetches(self, dyn, monkeypatch):
+        calls = []
+        def remote(http, *args):
+            calls.append(http['target'])
+            return '{"n": 1}', 'json'
+        monkeypatch.setattr('xmt.recipes.dynamic.processor.load_remote', remote)
+        dyn.spec['var'].extend([{'data': {'http': 'http://h/{{ page }}', 'do': 'jsonpath', 'return': '$.n'}},
+                                {'page': 0}])
+        dyn.spec['var'].reverse()
+        assert [diff['data'] for diff, _ in dyn.execute_many([{'page': 1}, {'page': 2}], workers=2)] == [1, 1]
+        assert sorted(calls) == ['http://h/1', 'http://h/2']
+
+
+class TestTargets:
+    @pytest.fixture
+    def pipeline(self, dyn, monkeypatch):
+        calls = []
+        def remote(http, *args):
+            calls.append(http['target'])
+            return '{"v": 1}', 'json'
+        monkeypatch.setattr('xmt.recipes.dynamic.processor.load_remote', remote)
+        dyn2 = deepcopy(dyn)
+        dyn2.spec['metadata']['id'] = 'dep'
+        dyn2.spec['var'].append({'y': {'http': 'http://h/dep', 'do': 'jsonpath', 'return': '$.v'}})
+        dyn.env['dep'] = dyn2.spec
+        dyn.spec['include'].append({'dynamic': 'dep'})
+        dyn.spec['var'].extend([{'a': 1},
+                                {'b': '{{ a }}2'},
+                                {'costly': {'http': 'http://h/costly', 'do': 'jsonpath', 'return': '$.v'}},
+                                {'c': '{{ dep.y }}'}])
+        dyn.execute(total=True, targets=['b'])     # a fresh plan, and nothing fetched yet
+        calls.clear()
+        return dyn, calls
+
+    def test_only_needed(self, pipeline):
+        dyn, calls = pipeline
+        diff, _ = dyn.execute(total=True, targets=['b'])
+        assert diff['b'] == '12' and 'costly' not in diff and 'RETURN' not in diff
+        assert calls == []
+
+    def test_includes(self, pipeline):
+        dyn, calls = pipeline
+        dyn.execute(total=True, targets=['c'])
+        assert dyn.diff['c'] == '1' and calls == ['http://h/dep']
+
+    def test_given(self, pipeline):
+        dyn, _ = pipeline
+        dyn.intialize()
+        positions, includes = dyn.plan.needed(['b'], {'a'})
+        assert [dyn.plan.vars[pos].name for pos in positions] == ['b'] and not includes
+        with pytest.raises(KeyError):
+            dyn.plan.needed(['missing'])
+
+    def test_getitem(self, pipeline):
+        dyn, calls = pipeline
+        dyn.intialize()
+        assert dyn['b'] == '12' and calls == []
+
+
+class TestUpdate:
+    @pytest.fixture
+    def monitor(self, dyn, monkeypatch):
+        calls = []
+        def remote(http, *args):
+            calls.append(http['target'])
+            return json.dumps({'n': len(calls)}), 'json'
+        monkeypatch.setattr('xmt.recipes.dynamic.processor.load_remote', remote)
+        dyn.spec['var'].extend([{'fetched': {'http': 'http://h/data', 'do': 'jsonpath', 'return': '$.n'}},
+                                {'threshold': 5},
+                                {'alert': '{{ fetched > threshold }}'},
+                                {'label': 'alert={{ alert }}'}])
+        dyn.spec['result'] = '{{ label }}'
+        dyn.execute(total=True)
+        return dyn, calls
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_downstream_only(self, monitor, workers):
+        dyn, calls = monitor
+        assert dyn['label'] == 'alert=False'
+        _, result = dyn.update(threshold=0, workers=workers)
+        assert result == 'alert=True' and dyn['threshold'] == 0
+        assert calls == ['http://h/data']      # not fetched again
+
+    def test_downstream(self, monitor):
+        dyn, _ = monitor
+        names = [var.name for var in dyn.plan.vars]
+        assert {names[pos] for pos in dyn.plan.downstream(['threshold'])} == {'alert', 'label', 'RETURN'}
+        assert {names[pos] for pos in dyn.plan.downstream(['label'])} == {'RETURN'}
+
+    def test_before_execute(self, monitor):
+        dyn, calls = monitor
+        dyn.intialize()
+        _, result = dyn.update(threshold=0)
+        assert result == 'alert=True' and len(calls) == 2
+
+
+class TestRun:
+    @pytest.fixture
+    def diamond(self, dyn, monkeypatch):
+        calls = []
+        def remote(http, *args):
+            calls.append(http['target'])
+            return '{"q": "quote"}', 'json'
+        monkeypatch.setattr('xmt.recipes.dynamic.processor.load_remote', remote)
+
+        def spec(id, include, var):
+            return {'metadata': {'id': id, 'type': 'dynamic'}, 'include': include, 'var': var, 'result': {}}
+        dyn.env['base'] = spec('base', [], [{'q': {'http': 'http://h/q', 'do': 'jsonpath', 'return': '$.q'}}])
+        dyn.env['left'] = spec('left', [{'dynamic': 'base'}], [{'l': '{{ base.q }}!'}])
+        dyn.env['right'] = spec('right', [{'dynamic': 'base'}], [{'r': '{{ base.q }}?'}])
+        dyn.spec['include'] += [{'dynamic': 'left'}, {'dynamic': 'right'}]
+        dyn.spec['var'].append({'both': '{{ left.l }} {{ right.r }}'})
+        return dyn, calls
+
+    def test_once_per_run(self, diamond):
+        dyn, calls = diamond
+        dyn.execute(total=True)
+        assert dyn['both'] == 'quote! quote?' and calls == ['http://h/q']
+        dyn.execute(total=True)
+        assert len(calls) == 2      # a new run
+
+    def test_threads(self, diamond):
+        dyn, calls = diamond
+        def make():
+            time.sleep(0.05)        # long enough for the other thread to ask meanwhile
+            return type(dyn)(dyn.env.load_recipe('base'), dyn.env, run=dyn.run)
+        with ThreadPoolExecutor(2) as pool:
+            first, second = pool.map(lambda _: dyn.run.include('base', make), range(2))
+        assert first is second and calls == ['http://h/q']
+
+
+class TestMap:
+    def test_jinja2(self, dyn):
+        dyn.spec['var'].extend([{'ids': [1, 2, 3]},
+                                {'doubled': {'map': 'ids', 'return': '{{ item * 2 }}'}},
+                                {'named': {'foreach': '{{ ids[1:] }}', 'as': 'n', 'return': 'n{{ n }}'}}])
+        dyn.execute(total=True)
+        assert dyn['doubled'] == ['2', '4', '6'] and dyn['named'] == ['n2', 'n3']
+
+    def test_args(self, dyn):
+        dyn.spec['var'].extend([{'posts': [{'title': 'a'}, {'title': 'b'}]},
+                                {'titles': {'map': 'posts', 'args': 'item', 'do': 'jsonpath', 'return': '$[0].title'}}])
+        dyn.execute(total=True)
+        assert dyn['titles'] == ['a', 'b']
+
+    def test_parallel(self, dyn, monkeypatch):
+        barrier = threading.Barrier(5)      # completes only if all five fetches are under way at once
+        def remote(http, *args):
+            barrier.wait(timeout=5)
+            return json.dumps({'id': http['target'].rsplit('/', 1)[1]}), 'json'
+        monkeypatch.setattr('xmt.recipes.dynamic.processor.load_remote', remote)
+        dyn.spec['var'].extend([{'ids': [5, 4, 3, 2, 1]},
+                                {'posts': {'map': 'ids', 'http': 'http://h/{{ item }}', 'do': 'jsonpath',
+                                           'return': '$.id', 'workers': 5}}])
+        dyn.execute(total=True)
+        assert not barrier.broken
+        assert dyn['posts'] == ['5', '4', '3', '2', '1']
+
+    def test_references(self, dyn):
+        from ..xmt.recipes.dynamic.parsing import compile_var
+        assert compile_var('x', {'map': 'ids', 'return': '{{ item }}{{ sep }}'}).references == {'ids', 'sep'}
+        with pytest.raises(Exception, match='not a list'):
+            dyn.spec['var'].extend([{'s': 'abc'}, {'x': {'map': 's', 'return': '{{ item }}'}}])
+            dyn.execute(total=True)
+
+
+class TestStream:
+    DOC = [{'data': {'children': [{'data': {'title': f'post "{i}" [{i}]', 'score': i}} for i in range(2000)]}}]
+
+    @pytest.fixture
+    def dump(self, dyn, tmp_path):
+        from ..xmt.recipes.storage import FileStorage
+        (tmp_path / 'dump.json').write_text(json.dumps(self.DOC), encoding='utf-8')
+        dyn.env.load_resource = FileStorage([str(tmp_path)]).load_resource
+        return dyn
+
+    @pytest.mark.parametrize('path', ['$[0].data.children[1500].data', '$[0].data.children[-1].data.score',
+                                      '$[0].data.children[2000]', '$[0].nope', '$[0].data.children[3].data.title'])
+    def test_same_as_parsed(self, path):
+        text = json.dumps(self.DOC)
+        chunks = (text[i:i + 100] for i in range(0, len(text), 100))
+        stream = processor.JsonStream(chunks)
+        assert stream.find(processor.jsonpath_steps(path)) == processor.compile_jsonpath(path)(self.DOC)
+        if '-' not in path:     # counting from the end reads the whole list
+            assert len(stream.buf) < 1000
+
+    def test_local(self, dump):
+        dump.spec['var'].extend([{'i': 7},
+                                 {'title': {'path': 'dump.json', 'stream': True, 'do': 'jsonpath',
+                                            'return': '$[0].data.children[{{ i }}].data.title'}},
+                                 {'titles': {'path': 'dump.json', 'stream': True, 'do': 'jsonpath',
+                                             'return': '$[0].data.children[*].data.score'}}])
+        dump.execute(total=True)
+        assert dump['title'] == 'post "7" [7]'
+        assert dump['titles'] == list(range(2000))       # not a simple path: parsed whole
+
+    def test_remote(self, dyn, stub):
+        stub.routes['/dump'] = [(200, json.dumps(self.DOC), {'Content-Type': 'application/json'}, 0)]
+        dyn.env.transport = Transport()
+        dyn.spec['var'].append({'x': {'http': stub.url('/dump'), 'stream': True, 'do': 'jsonpath',
+                                      'return': '$[0].data.children[1999].data.score'}})
+        dyn.execute(total=True)
+        assert dyn['x'] == 1999
+
+    def test_error_status(self, dyn, stub):
+        stub.routes['/gone'] = [(404, '{"error": "gone"}', {}, 0)]
+        dyn.env.transport = Transport()
+        for stream in (False, True):
+            dyn.spec['var'] = [{'x': {'http': stub.url('/gone'), 'stream': stream, 'do': 'jsonpath', 'return': '$.error'}}]
+            dyn.execute(total=True)
+            assert dyn['x'] == 'gone'
+
+    def test_validation(self):
+        from ..xmt.recipes.dynamic.parsing import compile_var
+        with pytest.raises(Exception, match='do: jsonpath'):
+            compile_var('x', {'path': 'a.json', 'stream': True})
+        with pytest.raises(Exception, match='cannot be cached'):
+            compile_var('x', {'http': 'u', 'stream': True, 'cache': 5, 'do': 'jsonpath', 'return': '$'})
+
+
+class TestRegex:
+    def test_modes(self):
+        assert processor.regex('sub', r'\d', 'a1b2', '#') == 'a#b#'
+        assert processor.regex('findall', r'\d', 'a1b2') == ['1', '2']
+        assert processor.regex('split', r'\d', 'a1b2') == ['a', 'b', '']
+        assert processor.regex('match', r'(\w)(\d)', 'a1b2') == ['a', '1']
+        assert processor.regex('match', r'(?P<n>\d)', 'a1') == {'n': '1'}
+        assert processor.regex('match', r'\d', 'ab') is None
+        assert processor.compile_regex(r'\d') is processor.compile_regex(r'\d')
+
+    def test_lists(self, sta):
+        assert processor.regex('findall', r'\d', ['a1', 'b', 'c23']) == [['1'], [], ['2', '3']]
+        sta.execute()
+        assert processor.regex('match', r'line(\d)', sta) == ['1', '2', '3']
+        assert processor.regex('sub', 'line', sta[sta['last_two']], 'L') == ['L2', 'L3']
+        assert processor.regex('findall', r'\d+', sta[0]) == ['1']      # a single row is its line
+        assert processor.regex('split', 'e', sta.content) == [['lin', '1'], ['lin', '2'], ['lin', '3']]
+
+    def test_recipe(self, dyn, sta):
+        dyn.env['dep_sta'] = sta.spec
+        dyn.spec['include'].append({'static': 'dep_sta'})
+        dyn.spec['var'].extend([{'pattern': r'(\d)'},
+                                {'text': 'v1.2'},
+                                {'parts': {'args': ['pattern', 'text'], 'do': 'regex', 'mode': 'split'}},
+                                {'digits': {'args': ['pattern', 'dep_sta'], 'do': 'regex', 'mode': 'match'}},
+                                {'masked': {'args': ['pattern', 'text'], 'do': 'regex', 'return': '#'}}])
+        dyn.execute(total=True)
+        assert dyn['parts'] == ['v', '1', '.', '2', '']
+        assert dyn['digits'] == ['1', '2', '3'] and dyn['masked'] == 'v#.#'
+
+    def test_validation(self):
+        from ..xmt.recipes.dynamic.parsing import compile_var
+        with pytest.raises(Exception, match='regex mode'):
+            compile_var('x', {'args': ['p', 's'], 'do': 'regex', 'mode': 'scan'})
+        with pytest.raises(Exception, match='return statement'):
+            compile_var('x', {'args': ['p', 's'], 'do': 'regex'})
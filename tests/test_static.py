@@ -1,11 +1,15 @@
 from calendar import c
 import pytest
 
+import os
 import sys
+import datetime
 from copy import deepcopy
 
 
-from ..xmt.recipes.static import parsing
+from ..xmt.recipes.static import parsing, processor
+from ..xmt.recipes.static.core import StaticRecipe
+from ..xmt.recipes.storage import RecipeCache, FileStorage
 
 class TestTags:
     def test_simple(self, sta):
@@ -81,6 +85,51 @@ class TestInclude:
         # check the annotations: the attached ones should have extra comments.
         assert all('extra-comment' in sta[i] for i in [3, 4, 5])
 
+    @pytest.fixture
+    def diamond(self, sta):
+        def recipe(id, content, tags = None):
+            return {'metadata': {'id': id, 'type': 'static'}, 'content': content, 'tags': tags or {}}
+        sta.env['base'] = recipe('base', ['a', 'b'], {'x': '1'})
+        sta.env['left'] = recipe('left', [{'include': 'base'}, 'l'])
+        sta.env['right'] = recipe('right', ['r', {'include': 'base'}])
+        sta.env['top'] = recipe('top', [{'include': 'left'}, {'include': 'right'}])
+        return sta.env
+
+    def test_diamond_cached(self, diamond):
+        top = StaticRecipe.load('top', diamond)
+        assert [row['content'] for row in top.content] == ['a', 'b', 'l', 'r', 'a', 'b']
+        assert top._tags['x'] == [1, 5]
+        assert diamond.cache.hits == 1          # base was executed once
+        assert StaticRecipe.load('top', diamond) is top
+
+    def test_cache_invalidation(self, diamond):
+        StaticRecipe.load('top', diamond)
+        hits, misses = diamond.cache.hits, diamond.cache.misses
+        diamond['base']['content'].append('c')
+        diamond['base'] = diamond['base']       # written again
+        top = StaticRecipe.load('top', diamond)
+        assert [row['content'] for row in top.content] == ['a', 'b', 'c', 'l', 'r', 'a', 'b', 'c']
+        # stale entries count as misses: top, left, right and base; base again is a hit
+        assert (diamond.cache.hits - hits, diamond.cache.misses - misses) == (1, 4)
+
+    def test_cache_eviction(self):
+        cache = RecipeCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert 'b' not in cache and cache.get('a') == 1 and cache.get('c') == 3
+        cache.record('hits')
+        assert (cache.hits, cache.misses) == (1, 0)
+
+    def test_file_version(self, tmp_path):
+        fs = FileStorage([str(tmp_path)])
+        assert fs.version('x') is None
+        (tmp_path / 'x.yaml').write_text('content: [a]')
+        before = fs.version('x')
+        (tmp_path / 'x.yaml').write_text('content: [a, b]')
+        assert fs.version('x') != before
+
 
 class TestIndexStrings:
     @pytest.mark.parametrize('input, expected', [
@@ -134,6 +183,41 @@ class TestIndexStrings:
         assert parsing.parse_index_string(input, total_len) == expected
 
 
+    @pytest.mark.parametrize('input, total_len, ranges', [
+        ('1..4;3..8', 10, [range(1, 9)]),
+        ('1..4;5,6;9', 10, [range(1, 7), range(9, 10)]),
+        ('1..9/2;5..20/2', 20, [range(1, 20, 2)]),
+        ('../2;1..10', 10, [range(1, 11)]),
+        ('1..10/2;2;4..5', 10, [range(1, 4, 2), range(2, 3), range(4, 6), range(7, 11, 2)]),
+        ('9;5..12/4;3..7/2', 20, [range(3, 8, 2), range(9, 10)]),
+    ])
+    def test_merge(self, input, total_len, ranges):
+        r = parsing.parse_index_string(input, total_len)
+        assert r.ranges == ranges
+        assert list(r) == sorted(set().union(*ranges)) and len(r) == len(list(r))
+
+    def test_lazy(self):
+        big = 10 ** 12
+        r = parsing.parse_index_string('../3;-5000..', big)
+        assert len(r) == len(range(1, big - 4999, 3)) + 5000
+        assert 1 in r and big in r and 2 not in r and big - 5000 not in r
+        assert repr(parsing.parse_index_string('1..9/2;12', 20)) == "IndexRanges('1..9/2;12')"
+
+    def test_overlapping_steps(self):
+        r = parsing.parse_index_string('1..12/3;1..12/2', 12)
+        assert not r.disjoint
+        assert list(r) == [1, 3, 4, 5, 7, 9, 10, 11] and len(r) == 8
+        assert [r[k] for k in range(-8, 8)] == list(r) * 2
+        assert r._expanded is not None       # expanded once, not per lookup
+
+    def test_collection(self):
+        r = processor.IndexCollection(parsing.parse_index_string('2..4;8..', 10), 10, 'r')
+        assert len(r) == 6 and 3 in r and 5 not in r
+        assert (~r)._indices is None      # complemented without expanding
+        assert (~r).indices == [1, 5, 6, 7]
+        assert r.to_bitmap().indices == [2, 3, 4, 8, 9, 10]
+        assert processor.IndexRanges.from_indices([5, 1, 2, 3, 3]).ranges == [range(1, 4), range(5, 6)]
+
     def test_parsing_simple(self, sta):
         sta.spec['tags']['test-exp-first'] = 1
         sta.spec['tags']['test-exp-all'] = [1, 2, 3]
@@ -145,4 +229,363 @@ class TestIndexStrings:
         assert sta.tags['test-exp-first'] == sta.tags['test-imp-first']
         assert sta.tags['test-exp-all'] == sta.tags['test-imp-all']
         assert sta.tags['test-exp-first'].indices == [1]
-        assert sta.tags['test-exp-all'].indices == [1, 2, 3]
\ No newline at end of file
+        assert sta.tags['test-exp-all'].indices == [1, 2, 3]
+
+class TestQuery:
+    @pytest.mark.parametrize('expr, expected', [
+        ('all', [1, 2, 3]),
+        ('all - first', [2, 3]),
+        ('all & ~first', [2, 3]),
+        ('~first & last_two', [2, 3]),
+        ('~all | first', [1]),
+        ('first | last_two - last_two', [1]),
+        ('(first | last_two) - last_two', [1]),
+        ('~first & ~last_two', []),
+        ('~(all - first)', [1]),
+        ('~~first', [1]),
+    ])
+    def test_query(self, sta, expr, expected):
+        sta.execute()
+        assert sta.query(expr).indices == expected
+
+    def test_matches_operators(self, sta):
+        sta.spec['tags']['special-tag'] = '2'
+        sta.execute()
+        assert sta.query('all & ~first | special-tag') == (sta['all'] & ~sta['first']) | sta['special-tag']
+        assert sta.query("all - 'special-tag'").indices == [1, 3]
+
+    def test_plan(self):
+        assert parsing.compile_query('a & ~b') == ('and', (('tag', 'a'),), (('tag', 'b'),))
+        assert parsing.compile_query('a - b - c') == parsing.compile_query('a & ~b & ~c')
+        assert parsing.compile_query('~a & ~b') == ('not', ('or', (('tag', 'a'), ('tag', 'b'))))
+
+    @pytest.mark.parametrize('expr', ['a &', '(a | b', 'a b', '&', ''])
+    def test_syntax_error(self, expr):
+        with pytest.raises(parsing.QuerySyntaxError):
+            parsing.compile_query(expr)
+
+
+class TestBitmap:
+    @pytest.fixture
+    def pair(self):
+        a, b = [1, 2, 5, 8, 9, 17], [2, 3, 8, 16, 17]
+        return (processor.IndexCollection(a, 20, 'a'), processor.IndexCollection(b, 20, 'b'),
+                processor.BitmapIndexCollection(a, 20, 'a'), processor.BitmapIndexCollection(b, 20, 'b'))
+
+    def test_operations(self, pair):
+        la, lb, ba, bb = pair
+        for op in [lambda x, y: x & y, lambda x, y: x | y, lambda x, y: x - y,
+                   lambda x, y: ~x, lambda x, y: ~y - x]:
+            assert op(ba, bb).indices == op(la, lb).indices
+            assert op(ba, lb).indices == op(la, lb).indices     # mixed backends
+
+    def test_api(self, pair):
+        la, _, ba, _ = pair
+        assert len(ba) == len(la) == 6
+        assert list(ba) == la.indices
+        assert 5 in ba and 4 not in ba and 0 not in ba
+        assert ba == la and hash(ba) == hash(la)
+        assert isinstance(ba.to_list(), processor.IndexCollection)
+        assert ba.to_list().indices == la.indices
+        assert la.to_bitmap().bits == ba.bits
+        assert not (ba - ba)
+
+    def test_recipe_backend(self, sta):
+        sta.spec['metadata']['index'] = 'bitmap'
+        sta.spec['tags']['middle'] = '2'
+        sta = StaticRecipe(sta.spec, sta.env)
+        sta.execute()
+        assert isinstance(sta['all'], processor.BitmapIndexCollection)
+        assert sta.query('all - middle').indices == [1, 3]
+        assert [str(row) for row in sta[sta['last_two']]] == ['line2', 'line3']
+
+
+class TestContent:
+    def test_columns(self, sta):
+        sta.spec['annotations']['sparse'] = {-1: 'last'}
+        sta.execute()
+        assert sta.content.columns['content'] == ['line1', 'line2', 'line3']
+        assert sta.content.columns['comment'] == ['first comment', 'second comment', 'third comment']
+        missing = sta.content.value('unknown', 0)       # the column of another copy of the module
+        assert sta.content.columns['sparse'] == [missing, missing, 'last'] and repr(missing) == 'MISSING'
+
+    def test_none_kept(self, sta, tmp_path):
+        sta.spec['annotations']['x'] = {1: None}
+        sta.execute()
+        assert 'x' in sta[1] and sta[1]['x'] is None and sta[1].x is None
+        assert 'x' not in sta[0] and sta[0].x == '' and dict(sta[1])['x'] is None
+
+        sta.save(str(tmp_path / 'sta.xmtc'))
+        sta.env.load_artifact = lambda name: open(tmp_path / 'sta.xmtc', 'rb').read()
+        loaded = StaticRecipe.load_artifact('basic', sta.env)
+        assert [dict(row).get('x', 'absent') for row in loaded] == ['absent', None, 'absent']
+
+    def test_row_view(self, sta):
+        sta.execute()
+        row = sta[0]
+        assert str(row) == 'line1' and row.comment == 'first comment' and row.missing == ''
+        assert dict(row) == {'content': 'line1', 'comment': 'first comment'}
+        assert 'comment' in row and 'sparse' not in row
+        assert sta[-1]['content'] == 'line3'
+        with pytest.raises(IndexError):
+            sta[3]
+
+    def test_views(self, sta):
+        sta.execute()
+        view = sta[1:]
+        assert len(view) == 2 and [str(row) for row in view] == ['line2', 'line3']
+        assert view[0].store is sta.content          # nothing copied
+        tagged = sta[sta['last_two']]
+        assert [row.comment for row in tagged] == ['second comment', 'third comment']
+        assert str(tagged[-1]) == 'line3'
+
+    def test_include_annotations(self, sta):
+        dep = deepcopy(sta.spec)
+        dep['metadata']['id'] = 'dep'
+        dep['annotations'] = {'extra': ['x', 'y']}
+        sta.env['dep'] = dep
+        sta.spec['content'].insert(0, {'include': 'dep'})
+        sta.spec['annotations'] = {'comment': {4: 'own'}}
+        sta.execute()
+        assert sta.content.columns['extra'] == ['x', 'y']
+        assert sta[4].comment == 'own' and 'comment' not in sta[0]
+        assert sta.content.to_records()[1] == {'content': 'line2', 'extra': 'y'}
+
+    def test_file_marker(self, tmp_path):
+        (tmp_path / 'corpus.txt').write_text('alpha\nbeta\r\ngamma\n', encoding='utf-8')
+        (tmp_path / 'corp.yaml').write_text(
+            "metadata: {id: corp, type: static}\n"
+            "content: [first, {file: corpus.txt}, last]\n"
+            "tags: {mapped: '2..4'}\n"
+            "annotations: {n: {2: 2}}\n")
+        fs = FileStorage([str(tmp_path)])
+        recipe = StaticRecipe.load('corp', fs)
+
+        assert len(recipe) == 5
+        assert [str(row) for row in recipe[recipe['mapped']]] == ['alpha', 'beta', 'gamma']
+        assert recipe[2].n == 2 and recipe[-1]['content'] == 'last'
+        assert isinstance(recipe.content.columns['content'].segments[1], processor.MappedLines)
+        assert list(processor.load_line_index(str(tmp_path / 'corpus.txt'))) == [0, 6, 12, 18]
+
+        (tmp_path / 'corpus.txt').write_text('alpha\nomega\n', encoding='utf-8')
+        assert processor.load_line_index(str(tmp_path / 'corpus.txt')) is None     # stale
+        recipe = StaticRecipe.load('corp', fs)
+        assert [row['content'] for row in recipe] == ['first', 'alpha', 'omega', 'last']
+
+
+class TestArtifact:
+    @pytest.fixture
+    def fs(self, tmp_path):
+        (tmp_path / 'corpus.txt').write_text('alpha\nbeta\n', encoding='utf-8')
+        (tmp_path / 'dep.yaml').write_text(
+            "metadata: {id: dep, type: static}\ncontent: [x, y]\ntags: {dep: '..'}\n")
+        (tmp_path / 'main.yaml').write_text(
+            "metadata: {id: main, type: static, index: bitmap}\n"
+            "content: [\"multi\\nline\\n\", {file: corpus.txt}, {include: dep}, 7]\n"
+            "tags: {odd: '../2', one: 1}\n"
+            "annotations: {n: {0: 1, 4: [2]}}\n")
+        return FileStorage([str(tmp_path)])
+
+    def test_roundtrip(self, fs):
+        fresh = StaticRecipe.load('main', fs)
+        fresh.save(fs.artifact_path('main'))
+
+        recipe = StaticRecipe.load_artifact('main', fs)
+        assert recipe is not None
+        assert [row['content'] for row in recipe] == [row['content'] for row in fresh] == \
+            ['multi\nline\n', 'alpha', 'beta', 'x', 'y', 7]
+        assert recipe.content.columns['content'].segments[0][-2:] == ['y', 7]
+        assert recipe.content.columns['n'] == fresh.content.columns['n']
+        assert recipe[4].n == [2] and 'n' not in recipe[1]
+        assert isinstance(recipe['odd'], processor.BitmapIndexCollection)
+        assert recipe.query('odd - dep').indices == [1, 3]
+        assert recipe['dep'] == fresh['dep']
+
+        recipe.execute()        # goes back to the source
+        assert len(recipe) == 6 and recipe['one'].indices == [1]
+
+    def test_text(self, fs, tmp_path):
+        (tmp_path / 'text.yaml').write_text("metadata: {id: text, type: static}\ncontent: [a, {file: corpus.txt}]\n")
+        StaticRecipe.load('text', fs).save(fs.artifact_path('text'))
+        recipe = StaticRecipe.load_artifact('text', fs)
+        lines = recipe.content.columns['content'].segments[0]
+        assert type(lines).__name__ == 'MappedLines' and list(recipe.content.columns['content']) == ['a', 'alpha', 'beta']
+
+        with lines:
+            assert not lines.source.closed
+        assert lines.source.closed
+        with pytest.raises(ValueError):     # the views over it are released
+            lines[0]
+
+    def test_stale(self, fs, tmp_path):
+        StaticRecipe.load('main', fs).save(fs.artifact_path('main'))
+        (tmp_path / 'dep.yaml').write_text(
+            "metadata: {id: dep, type: static}\ncontent: [x, y, z]\n")
+        assert StaticRecipe.load_artifact('main', fs) is None
+        assert len(StaticRecipe.load('main', FileStorage([str(tmp_path)]))) == 7
+
+        # an artifact older than its source is ignored
+        StaticRecipe.load('main', fs).save(fs.artifact_path('main'))
+        os.utime(fs.artifact_path('main'), (0, 0))
+        assert fs.load_artifact('main') is None
+
+    def test_failed_save(self, fs, tmp_path):
+        recipe = StaticRecipe.load('main', fs)
+        recipe.content.annotate('when', 1, datetime.date(2020, 1, 1))
+        with pytest.raises(TypeError):
+            recipe.save(fs.artifact_path('main'))
+        assert not os.path.exists(fs.artifact_path('main'))
+        assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+    @pytest.mark.parametrize('data', [b'', processor.ARTIFACT_MAGIC, b'junk' * 10])
+    def test_broken(self, fs, data):
+        StaticRecipe.load('main', fs).save(fs.artifact_path('main'))
+        full = open(fs.artifact_path('main'), 'rb').read()
+        for broken in (data, full[:len(full) - 3]):
+            with open(fs.artifact_path('main'), 'wb') as fp: fp.write(broken)
+            assert StaticRecipe.load_artifact('main', fs) is None
+            assert len(StaticRecipe.load('main', FileStorage(fs.paths))) == 6
+
+    def test_path_spelling(self, fs, tmp_path, monkeypatch):
+        StaticRecipe.load('main', fs).save(fs.artifact_path('main'))
+        monkeypatch.chdir(tmp_path)
+        for paths in (['.'], [''], [str(tmp_path) + '/./']):
+            assert StaticRecipe.load_artifact('main', FileStorage(paths)) is not None
+
+
+class TestSearch:
+    @pytest.fixture
+    def searchable(self, sta):
+        sta.spec['metadata']['search'] = True
+        sta.spec['content'] = ['The quick fox', 'a lazy dog', 'the lazy FOX jumps']
+        return StaticRecipe(sta.spec, sta.env)
+
+    def test_search(self, searchable):
+        searchable.execute()
+        assert searchable.search('fox').indices == [1, 3]
+        assert searchable.search('Lazy fox').indices == [3]
+        assert searchable.search('cat').indices == []
+        assert (searchable.search('lazy') - searchable['last_two']).indices == []
+        assert searchable.query('all - first') & searchable.search('fox') == searchable.search('lazy fox')
+
+    def test_include(self, searchable, tmp_path):
+        (tmp_path / 'corpus.txt').write_text('fox in a file\n', encoding='utf-8')
+        searchable.env.load_resource = FileStorage([str(tmp_path)]).load_resource
+        dep = deepcopy(searchable.spec)
+        dep['metadata']['id'] = 'dep'
+        searchable.env['dep'] = dep
+        plain = deepcopy(searchable.spec)
+        plain['metadata'] = {'id': 'plain', 'type': 'static'}
+        searchable.env['plain'] = plain
+        searchable.spec['content'] += [{'include': 'dep'}, {'file': 'corpus.txt'}, {'include': 'plain'}]
+        searchable.execute()
+
+        assert searchable.search('fox').indices == [1, 3, 4, 6, 7, 8, 10]
+        assert StaticRecipe.load('dep', searchable.env).search_index is not None
+
+    def test_unaliased(self, searchable):
+        searchable.execute()
+        found = searchable.search('fox')
+        assert found.indices is not searchable.search_index.lookup('fox')
+        found.indices.append(2)
+        assert searchable.search('fox').indices == [1, 3]
+
+    def test_artifact(self, tmp_path):
+        (tmp_path / 'docs.yaml').write_text(
+            "metadata: {id: docs, type: static, search: true}\ncontent: [a fox, a dog, 7]\n")
+        fs = FileStorage([str(tmp_path)])
+        StaticRecipe.load('docs', fs).save(fs.artifact_path('docs'))
+        recipe = StaticRecipe.load_artifact('docs', fs)
+        assert recipe.search_index._postings is None        # left encoded until searched
+        assert recipe.search('fox').indices == [1] and recipe.search('7').indices == [3]
+        assert [row['content'] for row in recipe] == ['a fox', 'a dog', 7]
+
+    def test_not_searchable(self, sta):
+        sta.execute()
+        with pytest.raises(Exception, match='not searchable'):
+            sta.search('line1')
+
+
+class TestWhere:
+    @pytest.fixture
+    def annotated(self, sta):
+        sta.spec['content'] = ['a', 'b', 'c', 'd', 'e']
+        sta.spec['annotations'] = {
+            'author': ['X', 'Y', 'X', None, 'X'],
+            'lang': {0: 'en', 1: 'en', 2: 'fr', 4: 'en'},
+            'year': [1850, 1999, 2000, 1920.5, 'unknown'],
+        }
+        sta.execute()
+        return sta
+
+    def test_values(self, annotated):
+        assert annotated.where(author='X').indices == [1, 3, 5]
+        assert annotated.where(author='X', lang='en').indices == [1, 5]
+        assert annotated.where(author='Z').indices == []
+        assert annotated.where(author='X') & annotated['last_two'] == annotated.where(author='X', lang='fr')
+
+    def test_ranges(self, annotated):
+        assert annotated.where(year=slice(1900, 2000)).indices == [2, 4]
+        assert annotated.where(year=slice(None, 1900)).indices == [1]
+        assert annotated.where(year=slice(1999, None), author='X').indices == [3]
+
+    def test_index_reuse(self, annotated):
+        annotated.where(author='X')
+        index = annotated.content.value_index('author')
+        annotated.where(author='Y')
+        assert annotated.content.value_index('author') is index
+        annotated.content.annotate('author', 3, 'Y')     # invalidates
+        assert annotated.where(author='Y').indices == [2, 4]
+
+
+class TestSample:
+    def test_uniform(self):
+        big = 10 ** 9
+        collection = processor.IndexCollection(parsing.parse_index_string('../2;-10..', big), big)
+        drawn = collection.sample(1000, seed=1)
+        assert all(i in collection for i in drawn)
+        assert collection._indices is None          # drawn without expanding
+        assert drawn == collection.sample(1000, seed=1)
+        assert sorted(collection.sample(5, replace=False, seed=2)) == sorted(set(collection.sample(5, replace=False, seed=2)))
+
+    @pytest.mark.parametrize('backend', ['list', 'bitmap'])
+    def test_rank(self, backend):
+        collection = processor.INDEX_BACKENDS[backend](parsing.parse_index_string('2..4;8;10..20/5', 20), 20)
+        assert [collection[k] for k in range(len(collection))] == [2, 3, 4, 8, 10, 15, 20]
+        assert collection[-1] == 20
+
+    def test_alias_table(self):
+        import random
+        table = processor.AliasTable([1, 0, 3])
+        rng = random.Random(0)
+        counts = [0, 0, 0]
+        for _ in range(4000):
+            counts[table.draw(rng)] += 1
+        assert counts[1] == 0 and 2.5 < counts[2] / counts[0] < 3.5
+        with pytest.raises(ValueError):
+            processor.AliasTable([0, 0])
+
+    def test_recipe(self, sta):
+        sta.spec['annotations']['weight'] = [0, 0, 5]
+        sta.execute()
+        rows = sta.sample('all', 20, weights='weight', seed=3)
+        assert len(rows) == 20 and {str(row) for row in rows} == {'line3'}
+        assert list(sta._alias_tables) == [('all', 'weight')]
+        assert {str(row) for row in sta.sample(sta['first'], 5)} == {'line1'}
+        assert str(sta.sample(seed=4)[0]) in {'line1', 'line2', 'line3'}
+
+    def test_reannotated(self, sta):
+        sta.spec['annotations']['weight'] = [1, 0, 0]
+        sta.execute()
+        assert {str(row) for row in sta.sample('all', 10, weights='weight')} == {'line1'}
+        sta.content.annotate('weight', 0, 0)
+        sta.content.annotate('weight', 1, 1)
+        assert list(sta.where(weight=1)) == [2]
+        assert {str(row) for row in sta.sample('all', 10, weights='weight')} == {'line2'}
+
+    def test_collection_weights(self, sta):
+        sta.spec['annotations']['weight'] = [0, 0, 5]
+        sta.execute()
+        collection = sta['last_two']        # passed as a collection, not by name
+        assert {str(row) for row in sta.sample(collection, 5, weights='weight')} == {'line3'}
+        assert collection._indices is None and not sta._alias_tables      # neither expanded nor kept
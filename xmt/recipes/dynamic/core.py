@@ -1,169 +1,253 @@
+import threading
+from copy import deepcopy
+from collections import ChainMap, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 from . import processor
 from ..base import Recipe, ParsingError
 from ..storage import Spec, Context, RecipeStorage
 from ..static.core import StaticRecipe
+from .parsing import SOURCES, PROCESSORS, TYPES, Var, compile_plan
 # TODO:
 #   2. Ensure that expr/return are paired correctly.
 #   3. Load static recipes.
 #   4. Remote inclusion caveats (e.g., cyclic dependency)
     
 
-SOURCES = ['args', 'path', 'http']
-PROCESSORS = ['jinja2', 'regex', 'jsonpath', 'xpath', 'nothing']
-TYPES = ['auto', 'text', 'json', 'yaml', 'binary']
+class Run:
+    """What one top-level execution shares with its whole include tree: the diffs of the
+    dynamic recipes included, by recipe id, so that each runs at most once. Safe to share
+    between threads; an include is executed under the lock, so a concurrent request for
+    it waits for that execution instead of repeating it."""
+    def __init__(self):
+        self.includes = {}
+        self._lock = threading.RLock()      # reentrant: included recipes include in turn
+
+    def include(self, recipe_id, make):
+        """The diff of the recipe make() builds, once executed, unless already done in this run."""
+        with self._lock:
+            if recipe_id not in self.includes:
+                recipe = make()
+                recipe.execute()
+                self.includes[recipe_id] = recipe.diff
+            return self.includes[recipe_id]
+
+    def __deepcopy__(self, memo):
+        run = Run()     # with a lock of its own
+        run.includes = deepcopy(self.includes, memo)
+        return run
+
 
 class DynamicRecipe(Recipe):
-    def __init__(self, spec : Spec, env : RecipeStorage, stack: list = None):
+    def __init__(self, spec : Spec, env : RecipeStorage, stack: list = None, run: Run = None):
         super().__init__(spec, env, stack)
         if self.type != 'dynamic':
             raise ParsingError(f'Exepcted a dynamic recipe, got recipe of type {self.type}')
         
-        self.original_spec = spec.copy()
+        self._owns_run = run is None    # top-level recipes start a new run with every execution
+        self.run = run or Run()
+        self.workers = self.spec['metadata'].get('workers', 1)
+        self.native = bool(self.spec['metadata'].get('native', False))     # render templates to Python values
         self.intialize()
 
     def intialize(self):
         self.diff = Context()
-        self.spec = self.original_spec
-        self.preprocess()
+        self.plan = compile_plan(self.spec, self.native)
         self.load_static()
 
-    def preprocess(self): # TODO: Implement preprocessing
-        if not 'var' in self.spec: self.spec['var'] = []
-        if not 'result' in self.spec: self.spec['result'] = {}
-
-        self.spec['var'].append(
-            {
-                'RETURN': self.spec['result'] 
-            }
-        )
-        for i, defn in enumerate(self.spec['var']):
-            var_name, var_dec = tuple(defn.items())[0]
-            
-            if isinstance(var_dec, dict) and not var_dec: continue # simply disregard it
-
-            if not isinstance(var_dec, dict):
-                if var_dec is not None:
-                    self.spec['var'][i] = {
-                        var_name: {
-                            'return': var_dec
-                        }
-                    }
-                    var_dec = self.spec['var'][i][var_name]
-                else:
-                    raise ParsingError(f'Missing definition - ensure proper indentation.')
-            # assert only one of the sources is present
-            sources_len = len([source for source in SOURCES if source in var_dec])
-            if sources_len == 0:
-                var_dec['args'] = []
-                var_dec['_source'] = 'args'
-
-            elif sources_len == 1:
-                assert var_dec != 'jinja2', 'Cannot have a jinja2 do block in a source-based variable definition.'
-
-                source = [source for source in SOURCES if source in var_dec][0]
-                var_dec['_source'] = source
-
-                if source in ['http', 'path']:          # flesh out
-                    if isinstance(var_dec[source], str):
-                        var_dec[source] = {
-                            'target': var_dec[source],
-                            'type': 'auto'
-                        }
-                    assert isinstance(var_dec[source], dict)
-                    if not 'type' in var_dec[source]:
-                        var_dec[source]['type'] = 'auto'
-
-                if source == 'args' and isinstance(var_dec['args'], str):
-                    var_dec['args'] = [var_dec['args']]
-            else:
-                raise ParsingError('Cannot have more than one source in a variable definition.')
-            
-            if 'do' not in var_dec:
-                var_dec['do'] = 'jinja2' if sources_len == 0 and isinstance(var_dec['return'], str) else 'nothing'
-
-            if var_dec['do'] != 'nothing' and not 'return' in var_dec:
-                raise ParsingError('Cannot have a do block without a return statement.')
-
     def load_static(self):
         self.process_includes(['static'])
         
-    def process_includes(self, which = []):
-        for defn in self.spec.get('include', []):
-            typ, name = tuple(defn.items())[0]
+    def process_includes(self, which = [], names = None):
+        for typ, name in self.plan.includes:
             if which and (not typ in which): continue
+            if names is not None and name not in names: continue
             if typ == 'dynamic':
                 spec = self.env.load_recipe(name)
-                recipe = DynamicRecipe(spec, self.env, self.stack)
-                recipe.execute()
-                self.diff[name] = recipe.diff # TODO: The identifier should be the ID
+                self.diff[name] = self.run.include(    # TODO: The identifier should be the ID
+                    spec['metadata']['id'], lambda: DynamicRecipe(spec, self.env, list(self.stack), self.run))
                 
             elif typ == 'static':
-                spec = self.env.load_recipe(name)
-                recipe = StaticRecipe(spec, self.env, self.stack)
-                recipe.execute(compile_tags = True)
+                recipe = StaticRecipe.load(name, self.env, self.stack)
                 self.diff[name] = recipe # TODO: The identifier should be the ID
             else:
                 raise ValueError('Unrecognized recipe type.')
         
-    def process_var(self, var_name, var_dec):
-        if not var_dec: return
-
+    def begin_run(self):
+        if self._owns_run:
+            self.run = Run()
+
+    def process_var(self, var : Var, context = None):
+        context = self.diff if context is None else context
+        context[var.name] = self.evaluate_var(var, context)
+
+    def evaluate_var(self, var : Var, context):
+        """Computes the value of a var, reading other values from context."""
+        if var.map is not None:
+            return self.map_var(var, context)
+        return self._evaluate(var, context)
+
+    def map_var(self, var : Var, context):
+        """Evaluates a var once per element of its list, map_workers at a time; the results keep its order."""
+        if processor.is_template(var.map):
+            items = (self.env.templates or processor.default_templates()).render(var.map, context, native=True)
+        else:
+            items = context[var.map]
+        if isinstance(items, (str, bytes, dict)) or not hasattr(items, '__iter__'):
+            raise ValueError(f'{var.name} maps over {var.map}, which is not a list.')
+
+        evaluate = lambda item: self._evaluate(var, ChainMap({var.alias: item}, context))
+        items = list(items)
+        if var.map_workers <= 1 or len(items) <= 1:
+            return [evaluate(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(var.map_workers, len(items))) as pool:
+            return list(pool.map(evaluate, items))
+
+    def _evaluate(self, var : Var, context):
         # Resolution step
-        _var_dec = var_dec.copy()
-        source = var_dec['_source']
-        _var_dec[source] = processor.interpret(var_dec[source], self.diff)
+        target = var.target
+        if var.templated:
+            target = processor.interpret(target, context, self.env.templates, var.native)
+
+        if var.stream:      # simple paths are read off the stream; others need the whole document
+            jpath = (self.env.templates or processor.default_templates()).render(var.ret, context)
+            if processor.jsonpath_steps(jpath) is not None:
+                if var.source == 'path':
+                    return processor.stream_local(target, self.env, jpath)
+                return processor.stream_remote(target, jpath, self.env.transport, self.env.rate_limiter)
 
         # Fetching step
-        fetched, type, strict = None, None, False
-        if source == 'args':
-            fetched = [self.diff[arg] for arg in var_dec['args']]
+        fetched, type = None, None
+        if var.source == 'args':
+            fetched = [context[arg] for arg in target]
 
-        elif source == 'path':
-            fetched, type = processor.load_local(_var_dec['path'], self.env)
-            if _var_dec['path']['type'] == 'auto' and type:
-                _var_dec['path']['type'] = type
+        elif var.source == 'path':
+            fetched, type = processor.load_local(target, self.env)
 
-        elif source == 'http':
-            strict = True   # adherence is strict
+        elif var.source == 'http':
             # TODO: Make this more general
-            fetched, type = processor.load_remote(_var_dec['http'])
-            if _var_dec['http']['type'] == 'auto' and type:
-                _var_dec['http']['type'] = type
+            fetched, type = processor.load_remote(
+                target, self.env.transport,
+                (self.env.http_cache or processor.default_cache()) if var.ttl is not None else None,
+                var.ttl,
+                self.env.singleflight,
+                self.env.rate_limiter,
+                var.private)
 
         else:
             raise ValueError('Unrecognized source type.') # should not be reached.
 
         # casting
-        if source != 'args':
+        if var.source != 'args':
             fetched = processor.cast(type, fetched)
 
         # Finalization
-        if 'return' in _var_dec:
-            value = processor.process(_var_dec['do'], fetched, _var_dec['return'], self.diff)
-        else:
-            value = fetched
-
-        self.diff[var_name] = value
-        
-    def process_vars(self):
-        for defn in self.spec['var']:
-            var_name, var_dec  = tuple(defn.items())[0]
-            self.process_var(var_name, var_dec)
+        if var.returns:
+            return processor.process(var.do, fetched, var.ret, context, self.env.templates, var.native, var.mode)
+        return fetched
+
+    def dependency_graph(self):
+        """For every var (by position in the plan), the positions of the earlier vars it reads."""
+        return [set(deps) for deps in self.plan.graph]
+
+    def process_vars(self, workers = None, context = None, given = (), only = None):
+        """Evaluates every var into context (the diff by default), except those named in given,
+        whose values are already there. only limits evaluation to a set of positions."""
+        workers = workers or self.workers
+        context = self.diff if context is None else context
+        variables, graph = self.plan.vars, self.plan.graph
+        if workers <= 1:
+            for pos, var in enumerate(variables):
+                if var.name not in given and (only is None or pos in only): self.process_var(var, context)
+            return
+
+        # Run every var as soon as the vars it reads are done. Each sees only those
+        # (over the includes, and the values already in context, for vars not run now),
+        # so results are committed in declaration order at the end.
+        pending = {pos for pos, var in enumerate(variables)
+                   if var.name not in given and (only is None or pos in only)}
+        scheduled, results, running = frozenset(pending), {}, {}
+
+        def submit(pool, pos):
+            deps = ChainMap({variables[dep].name: results[dep] for dep in sorted(graph[pos] & scheduled)}, context)
+            running[pool.submit(self.evaluate_var, variables[pos], deps)] = pos
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for pos in sorted(pending):
+                    if graph[pos] & scheduled <= results.keys():
+                        pending.discard(pos)
+                        submit(pool, pos)
+                if not running: continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+
+        for pos in sorted(results):
+            context[variables[pos].name] = results[pos]
+
+    def update(self, workers: int = None, **values):
+        """Sets vars (or inputs) to new values, and recomputes only the vars downstream of
+        them; everything upstream, fetched payloads included, is kept. The vars set are not
+        recomputed. Returns the diff and the result, like execute."""
+        self.begin_run()
+        self.process_includes(['dynamic'], {name for _, name in self.plan.includes if name not in self.diff})
+        self.diff.update(values)
+        dirty = self.plan.downstream(values)
+        missing = {pos for pos, var in enumerate(self.plan.vars) if var.name not in self.diff}
+        self.process_vars(workers, given = values, only = dirty | missing)
+        return self.diff, self.diff.get('RETURN', None)
 
     def value(self):
         return self.diff['RETURN']
 
-    def execute(self, total: bool =False, state: dict = None):
+    def execute(self, total: bool =False, state: dict = None, workers: int = None, targets: list = None):
+        """Runs the recipe. The values in state are in place before any var is evaluated,
+        and stand in for the vars they name. With targets (var or include names), only what
+        they depend on is evaluated."""
         if total: 
             self.intialize()
+        self.begin_run()
         
-        self.process_includes(['dynamic'])
-        self.process_vars()
-        
-        if state: 
+        positions, includes = self.plan.needed(targets, state or ()) if targets is not None else (None, None)
+        self.process_includes(['dynamic'], includes)
+        if state:
             self.diff.update(state)
+        self.process_vars(workers, given = state or (), only = positions)
         
         return self.diff, self.diff.get('RETURN', None)
 
+    def execute_many(self, states, workers: int = None):
+        """Runs the recipe once per state (as in execute), yielding (diff, result) pairs in order
+        as they are ready. The plan, the includes and the fetch caches are shared by the whole
+        batch; workers sets how many states run at once."""
+        workers = workers or self.workers
+        self.intialize()
+        self.begin_run()
+        self.process_includes(['dynamic'])
+        base = Context(self.diff)
+
+        def run(state):
+            diff = Context(base)
+            diff.update(state or {})
+            self.process_vars(1, diff, state or ())
+            return diff, diff.get('RETURN', None)
+
+        if workers <= 1:
+            for state in states:
+                yield run(state)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            window = deque()       # bounded, so states are read and results kept only a little ahead
+            for state in states:
+                window.append(pool.submit(run, state))
+                if len(window) >= 2 * workers:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+
     def __getitem__(self, var):
+        if var not in self.diff:        # not evaluated yet: evaluate just what it takes
+            self.execute(targets=[var])
         return self.diff[var]
\ No newline at end of file
@@ -0,0 +1,215 @@
+import json
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from typing import NamedTuple
+
+from . import processor
+from ..base import ParsingError
+
+SOURCES = ['args', 'path', 'http']
+PROCESSORS = ['jinja2', 'regex', 'jsonpath', 'xpath', 'nothing']
+TYPES = ['auto', 'text', 'json', 'yaml', 'binary']
+MAP_WORKERS = 8         # elements of a mapped var evaluated at once, by default
+
+
+class Var(NamedTuple):
+    """A normalized var declaration."""
+    name: str
+    source: str             # 'args', 'path' or 'http'
+    target: object          # the arg names, or the path/http declaration
+    templated: bool         # whether target holds templates, rendered on every run
+    do: str
+    returns: bool
+    ret: object
+    native: bool
+    ttl: object             # how long http responses stay cached, in seconds; None disables caching
+    private: bool           # whether to cache responses to requests with credentials, too
+    references: frozenset   # the names it reads
+    map: object = None      # with map/foreach, the list (a name or a template) to evaluate it over
+    alias: str = 'item'     # the name each element goes by
+    map_workers: int = MAP_WORKERS
+    stream: bool = False    # whether to read a JSON source incrementally, keeping only what the path matches
+    mode: str = 'sub'       # for regex: sub, findall, match or split
+
+
+class Plan(NamedTuple):
+    """A dynamic recipe spec, compiled. Plans are shared across recipes and threads, and
+    never mutated: what they hold is handed out as copies."""
+    vars: tuple
+    includes: tuple         # (type, name) pairs
+    graph: tuple            # for every var, the positions of the earlier vars it reads
+
+    def needed(self, targets, given = ()):
+        """What computing targets (var or include names) takes: the positions of the vars,
+        and the names of the includes. Vars named in given are taken as known."""
+        last = {var.name: pos for pos, var in enumerate(self.vars)}
+        include_names = {name for _, name in self.includes}
+        stack, includes = [], set()
+        for target in targets:
+            if target in last: stack.append(last[target])
+            elif target in include_names: includes.add(target)
+            else: raise KeyError(target)
+
+        positions = set()
+        while stack:
+            pos = stack.pop()
+            if pos in positions or self.vars[pos].name in given: continue
+            positions.add(pos)
+            includes |= self.vars[pos].references & include_names
+            stack.extend(self.graph[pos])
+        return positions, includes
+
+    def downstream(self, names):
+        """The positions of the vars that read any of names, directly or through other vars;
+        the vars named themselves excepted."""
+        names, dirty = set(names), set()
+        for pos, var in enumerate(self.vars):
+            if var.name not in names and (var.references & names or self.graph[pos] & dirty):
+                dirty.add(pos)
+        return dirty
+
+
+def _has_templates(d):
+    found = []
+    processor.recurse_object(d, lambda s: found.append(processor.is_template(s)), str)
+    return any(found)
+
+
+def compile_var(var_name, var_dec, native = False):
+    """Normalizes a var declaration into a Var; None for an empty one, which is disregarded."""
+    if isinstance(var_dec, dict) and not var_dec: return None
+
+    if not isinstance(var_dec, dict):
+        if var_dec is None:
+            raise ParsingError(f'Missing definition - ensure proper indentation.')
+        var_dec = {'return': var_dec}
+    else:
+        var_dec = deepcopy(var_dec)     # the spec itself is left as written
+
+    over = None
+    if 'map' in var_dec or 'foreach' in var_dec:   # evaluated once per element of a list
+        if 'map' in var_dec and 'foreach' in var_dec:
+            raise ParsingError('Cannot have both map and foreach in a variable definition.')
+        over = var_dec.pop('map') if 'map' in var_dec else var_dec.pop('foreach')
+        if not isinstance(over, str):
+            raise ParsingError('map/foreach takes the name of a list, or a template.')
+
+    # assert only one of the sources is present
+    sources = [source for source in SOURCES if source in var_dec]
+    if len(sources) > 1:
+        raise ParsingError('Cannot have more than one source in a variable definition.')
+    if not sources:
+        var_dec['args'] = []
+        source = 'args'
+    else:
+        assert var_dec != 'jinja2', 'Cannot have a jinja2 do block in a source-based variable definition.'
+        source = sources[0]
+
+        if source in ['http', 'path']:          # flesh out
+            if isinstance(var_dec[source], str):
+                var_dec[source] = {
+                    'target': var_dec[source],
+                    'type': 'auto'
+                }
+            assert isinstance(var_dec[source], dict)
+            if not 'type' in var_dec[source]:
+                var_dec[source]['type'] = 'auto'
+
+        if source == 'args' and isinstance(var_dec['args'], str):
+            var_dec['args'] = [var_dec['args']]
+    var_dec['_source'] = source
+
+    if 'do' not in var_dec:
+        var_dec['do'] = 'jinja2' if not sources and isinstance(var_dec['return'], str) else 'nothing'
+
+    mode = var_dec.get('mode', 'sub')
+    if 'mode' in var_dec and var_dec['do'] != 'regex':
+        raise ParsingError('Only regex do blocks take a mode.')
+    if mode not in processor.REGEX_MODES:
+        raise ParsingError(f'Unrecognized regex mode {mode}.')
+
+    if var_dec['do'] != 'nothing' and not 'return' in var_dec and not (var_dec['do'] == 'regex' and mode != 'sub'):
+        raise ParsingError('Cannot have a do block without a return statement.')
+
+    ttl, private = None, False
+    if 'cache' in var_dec:                      # response caching, for http sources
+        if source != 'http':
+            raise ParsingError('Only http sources can be cached.')
+        cache = var_dec['cache'] if isinstance(var_dec['cache'], dict) else {'ttl': var_dec['cache']}
+        ttl, private = cache['ttl'], bool(cache.get('private', False))
+
+    stream = bool(var_dec.get('stream', False))
+    if stream:
+        if source not in ('path', 'http') or var_dec['do'] != 'jsonpath':
+            raise ParsingError('Only path and http sources with do: jsonpath can be streamed.')
+        if var_dec[source]['type'] not in ('auto', 'json'):
+            raise ParsingError('Only JSON sources can be streamed.')
+        if ttl is not None:
+            raise ParsingError('Streamed sources cannot be cached.')
+
+    references = processor.references(var_dec)
+    if over is not None:
+        alias = var_dec.get('as', 'item')
+        references.discard(alias)
+        references |= processor._free_names(over) if processor.is_template(over) else {over}
+
+    return Var(
+        name = var_name,
+        source = source,
+        target = var_dec[source],
+        templated = source != 'args' and _has_templates(var_dec[source]),
+        do = var_dec['do'],
+        returns = 'return' in var_dec or var_dec['do'] == 'regex',
+        ret = var_dec.get('return'),
+        native = bool(var_dec.get('native', native)),
+        ttl = ttl,
+        private = private,
+        references = frozenset(references),
+        map = over,
+        alias = var_dec.get('as', 'item'),
+        map_workers = var_dec.get('workers', MAP_WORKERS),
+        stream = stream,
+        mode = mode,
+    )
+
+
+def _compile_plan(spec, native):
+    variables = []
+    for defn in list(spec.get('var') or []) + [{'RETURN': spec.get('result') or {}}]:
+        var = compile_var(*tuple(defn.items())[0], native)
+        if var is not None: variables.append(var)
+
+    graph, defined = [], {}
+    for pos, var in enumerate(variables):
+        graph.append(frozenset(defined[name] for name in var.references if name in defined))
+        defined[var.name] = pos
+
+    includes = tuple(tuple(defn.items())[0] for defn in spec.get('include') or [])
+    return Plan(tuple(variables), includes, tuple(graph))
+
+
+PLAN_CACHE_SIZE = 256
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+def compile_plan(spec, native = False) -> Plan:
+    """The plan of a dynamic recipe spec. Plans are cached by the content of the spec,
+    so executing the same spec again, from any recipe or thread, compiles nothing."""
+    try:
+        key = json.dumps([spec.get('var'), spec.get('result'), spec.get('include'), native],
+                         sort_keys=True, default=repr)
+    except TypeError:       # keys that cannot be sorted; such specs are not cached
+        return _compile_plan(spec, native)
+
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+    plan = _compile_plan(spec, native)
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
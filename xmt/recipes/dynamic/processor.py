@@ -1,16 +1,24 @@
 import os.path
+import codecs
+import time
+import threading
+from copy import deepcopy
+from urllib.parse import urlsplit
 
 import yaml
 import json
 import re
 from jsonpath_ng import parse as parse_jsonpath
 
-from jinja2 import Template
-
-import requests
+from functools import lru_cache
+from jinja2 import Template, Environment, BaseLoader, FileSystemBytecodeCache, meta
+from jinja2.nativetypes import NativeEnvironment
 
 from xmt.recipes.base import ParsingError
 from xmt.recipes.storage import Context, FileStorage
+from xmt.recipes.static.core import StaticRecipe
+from xmt.recipes.static.processor import ContentStore, ContentView, ContentWrapper
+from .transport import Transport, ResponseCache, default_transport, default_cache, carries_credentials
 
 EXT_TYP_MAP = {
     'json': 'json',
@@ -36,15 +44,166 @@ def recurse_object(d, func, on):
     else:
         return d
 
-def recursive_freeze(d): 
-    return recurse_object(d, Template, str)
+def is_template(s : str) -> bool:
+    return '{{' in s or '{%' in s or '{#' in s
+
+
+class _SourceLoader(BaseLoader):
+    # the name of a template is its source; counts the templates that had to be loaded
+    def __init__(self):
+        self.loads = 0
+
+    def get_source(self, environment, template):
+        self.loads += 1
+        return template, None, lambda: True
+
+
+class Templates:
+    ''' One Environment for every template string in var declarations. The last size compiled
+    templates are kept by source; with bytecode_dir, compiled code also persists across runs.
+    Extra options are passed on to the Environment. Native rendering goes through a
+    NativeEnvironment with the same settings, which returns Python values instead of text. '''
+    def __init__(self, size = 1024, bytecode_dir = None, **options):
+        self.loader = _SourceLoader()
+        self._settings = dict(
+            loader = self.loader, cache_size = size,
+            bytecode_cache = FileSystemBytecodeCache(os.path.expanduser(bytecode_dir)) if bytecode_dir else None,
+            **options)
+        self.environment = Environment(**self._settings)
+        self._native = None
+
+    @property
+    def native_environment(self):
+        if self._native is None:
+            self._native = NativeEnvironment(**self._settings)
+        return self._native
+
+    def get(self, source : str, native = False) -> Template:
+        return (self.native_environment if native else self.environment).get_template(source)
+
+    def render(self, source : str, context, native = False):
+        if not is_template(source):   # renders to itself, less the trailing newline jinja drops
+            keep = self.environment.keep_trailing_newline
+            return source[:-1] if source.endswith('\n') and not keep else source
+        return self.get(source, native).render(context)
+
+    @property
+    def compiles(self):
+        ''' Templates compiled (or read from the bytecode cache) so far. '''
+        return self.loader.loads
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+_templates = None
+
+def default_templates() -> Templates:
+    global _templates
+    if _templates is None:
+        _templates = Templates()
+    return _templates
+
+def recursive_freeze(d, templates : Templates = None):
+    templates = templates or default_templates()
+    return recurse_object(d, lambda s: templates.get(s) if is_template(s) else s, str)
 def recursive_render(d, vars : dict):
     def func(d):
         return d.render(vars)
     return recurse_object(d, func, Template)
 # convenience wrapper
-def interpret(d : dict, context : dict):
-    return recursive_render(recursive_freeze(d), context)
+def interpret(d : dict, context : dict, templates : Templates = None, native = False):
+    templates = templates or default_templates()
+    return recurse_object(d, lambda s: templates.render(s, context, native), str)
+
+_parse_env = Environment()
+
+@lru_cache(maxsize=4096)
+def _free_names(s : str) -> frozenset:
+    return frozenset(meta.find_undeclared_variables(_parse_env.parse(s))) if is_template(s) else frozenset()
+
+def references(var_dec : dict) -> set:
+    ''' The names a preprocessed var declaration reads: its args and the free variables of its templates. '''
+    source = var_dec['_source']
+    names = set(var_dec['args']) if source == 'args' else set()
+    templates = [var_dec[source]] if source != 'args' else []
+    if var_dec['do'] in ('jinja2', 'jsonpath'):
+        templates.append(var_dec.get('return'))
+
+    def visit(s):
+        names.update(_free_names(s))
+    recurse_object(templates, visit, str)
+    return names
+
+### CONCURRENCY
+
+class SingleFlight:
+    ''' Collapses concurrent calls with the same key: the first caller runs the call,
+    and the others wait for and share its result (or exception). '''
+    class _Call:
+        __slots__ = ('done', 'result', 'error')
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0     # calls served by another caller's flight
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None: raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class RateLimiter:
+    ''' A token bucket per host: rate requests per second on average, in bursts of up to burst.
+    hosts optionally maps a host name to its own (rate, burst). '''
+    def __init__(self, rate, burst = 1, hosts = None):
+        self.rate, self.burst = rate, burst
+        self.hosts = hosts or {}
+        self._lock = threading.Lock()
+        self._buckets = {}      # host -> [tokens, last refill]
+
+    def acquire(self, host):
+        ''' Takes a token for host, sleeping until one is available. '''
+        rate, burst = self.hosts.get(host, (self.rate, self.burst))
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(host, [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            bucket[0] -= 1          # reserved, even if it still has to be waited for
+            wait = -bucket[0] / rate if bucket[0] < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def __deepcopy__(self, memo):
+        return self
+
 
 ### LOADERS
 def load_local(path : dict, env : FileStorage):
@@ -60,53 +219,328 @@ def load_local(path : dict, env : FileStorage):
     else:
         return env.load_resource(target, 'r', encoding='utf-8').read(), inferred_type
     
-def load_remote(http : dict):
+def _remote_request(http : dict):
     url = http['target']
-    expected_type = http['type']
-    http['headers'] = http.get('headers', {})
+    headers = dict(http.get('headers', {}))    # declarations are shared by every run; leave them be
 
     data = http.get('data', None)
     if isinstance(data, dict) or isinstance(data, list):
         data = json.dumps(data)
-        if not 'Content-Type' in http['headers']:
-            http['headers']['Content-Type'] = 'application/json'
+        if not 'Content-Type' in headers:
+            headers['Content-Type'] = 'application/json'
 
-    resp = requests.request(
-        http.get('method', 'GET'),
-        url = url,
-        headers = http['headers'],
-        data = data
-    )
+    kwargs = {'headers': headers, 'data': data}
+    if 'timeout' in http:
+        kwargs['timeout'] = http['timeout']
+    return http.get('method', 'GET'), url, kwargs
 
+def _remote_response(body : bytes, type_header : str, expected_type):
     # infer type
-    type_header = resp.headers['Content-Type']
     inferred_type = expected_type
     if 'application/json' in type_header:
         inferred_type = 'json'
     # (should add more type inference)
 
-    return resp.content.decode('utf-8'), inferred_type
+    return body.decode('utf-8'), inferred_type
+
+def load_remote(http : dict, transport : Transport = None, cache : ResponseCache = None, ttl = None,
+                singleflight : SingleFlight = None, limiter : RateLimiter = None, private = False):
+    ''' Fetches an http source. With a cache and a ttl (in seconds), responses younger than ttl
+    are served from the cache, and older ones are revalidated with a conditional request.
+    Requests with credentials (and responses setting cookies) are only cached if private.
+    With singleflight, concurrent identical GET/HEAD fetches share one request; with a
+    limiter, requests wait for their host's rate limit. '''
+    method, url, kwargs = _remote_request(http)
+    fetch = lambda: _load_remote(method, url, kwargs, http['type'], transport or default_transport(),
+                                 cache, ttl, limiter, private)
+    if singleflight is not None and method.upper() in ('GET', 'HEAD'):
+        key = (ResponseCache.key(method, url, kwargs['headers'], kwargs['data']), http['type'], kwargs.get('timeout'))
+        return singleflight.do(key, fetch)
+    return fetch()
+
+def _load_remote(method, url, kwargs, expected_type, transport, cache, ttl, limiter, private):
+    def request(**extra):
+        if limiter is not None:
+            limiter.acquire(urlsplit(url).hostname)
+        return transport.request(method, url, **{**kwargs, **extra})
+
+    if cache is None or ttl is None or (not private and carries_credentials(kwargs['headers'])):
+        resp = request()
+        return _remote_response(resp.content, resp.headers.get('Content-Type', ''), expected_type)
+
+    key = cache.key(method, url, kwargs['headers'], kwargs['data'])
+    entry = cache.get(key)
+    conditional = {}
+    if entry is not None:
+        meta, body = entry
+        if time.time() - meta['stored'] < ttl:
+            cache.record('hits')
+            return _remote_response(body, meta['content_type'], expected_type)
+        if meta['etag']: conditional['If-None-Match'] = meta['etag']
+        if meta['last_modified']: conditional['If-Modified-Since'] = meta['last_modified']
+
+    resp = request(headers = {**kwargs['headers'], **conditional})
+    if entry is not None and resp.status_code == 304:
+        cache.touch(key, meta)
+        cache.record('revalidations')
+        return _remote_response(body, meta['content_type'], expected_type)
+
+    cache.record('misses')
+    if resp.ok and (private or not carries_credentials(resp.headers)):
+        cache.put(key, resp.content, resp.headers)
+    return _remote_response(resp.content, resp.headers.get('Content-Type', ''), expected_type)
+
+async def aload_remote(http : dict, transport : Transport = None):
+    ''' load_remote, for concurrent fetches from an asyncio loop. '''
+    method, url, kwargs = _remote_request(http)
+    resp = await (transport or default_transport()).arequest(method, url, **kwargs)
+    return _remote_response(resp.content, resp.headers.get('Content-Type', ''), http['type'])
 
 ### PROCESSING
-def process(func: str, fetched, ret, state: Context):
+def process(func: str, fetched, ret, state: Context, templates : Templates = None, native = False, mode = 'sub'):
+    templates = templates or default_templates()
     if func == 'jsonpath':
-        return jsonpath_query(fetched, Template(ret).render(**state))
+        return jsonpath_query(fetched, templates.render(ret, state))
     elif func == 'regex':
-        return re.sub(fetched[0], ret, fetched[1])
-    elif func == 'nothing':
-        return ret
+        return regex(mode, fetched[0], fetched[1], ret)
+    elif func == 'nothing':     # ret belongs to a shared plan; hand out a copy of it
+        return ret if isinstance(ret, str) else deepcopy(ret)
     elif func == 'jinja2':
         assert not fetched, 'jinja2 does not support multiple inputs'
-        return Template(ret).render(**state)
+        return templates.render(ret, state, native)
+
+
+REGEX_MODES = ['sub', 'findall', 'match', 'split']
+
+@lru_cache(maxsize=1024)
+def compile_regex(pattern : str):
+    return re.compile(pattern)
+
+def _match(m):
+    if m is None: return None
+    if m.re.groupindex: return m.groupdict()
+    if m.re.groups: return m.group(1) if m.re.groups == 1 else list(m.groups())
+    return m.group(0)
+
+def _lines(subject):
+    # static recipes, their content and views of it stand for their lines; a row for its line
+    if isinstance(subject, StaticRecipe):
+        subject = subject.content
+    if isinstance(subject, ContentStore):
+        return list(subject.columns['content'])
+    if isinstance(subject, ContentView):
+        return [row['content'] for row in subject]
+    if isinstance(subject, ContentWrapper):
+        return subject['content']
+    return subject
+
+def regex(mode, pattern, subject, repl = None):
+    ''' Applies pattern to subject, or to every item of a list of subjects (or line of a static recipe):
+    sub replaces matches with repl, findall lists them, match gives the first one (its groups,
+    if the pattern has any), and split splits on them. '''
+    compiled = compile_regex(pattern)
+    if mode == 'sub': apply = lambda s: compiled.sub(repl, s)
+    elif mode == 'findall': apply = compiled.findall
+    elif mode == 'match': apply = lambda s: _match(compiled.search(s))
+    elif mode == 'split': apply = compiled.split
+    else: raise ValueError(f'Unrecognized regex mode {mode}.')
 
+    subject = _lines(subject)
+    if isinstance(subject, (list, tuple)):
+        return [apply(s) for s in subject]
+    return apply(subject)
+
+
+_JSONPATH_STEP = re.compile(r"\.([\w@-]+)|\[(-?\d+)\]|\['([^'\]]*)'\]|\[\"([^\"\]]*)\"\]", re.ASCII)
+
+@lru_cache(maxsize=1024)
+def jsonpath_steps(jpath):
+    ''' The steps of a path made of child and index steps only, like $[0].data.children[0]['title'],
+    as a tuple of keys and ints; None for any other path. '''
+    if not jpath.startswith('$'):
+        return None
+    steps, pos = [], 1
+    while pos < len(jpath):
+        m = _JSONPATH_STEP.match(jpath, pos)
+        if m is None:
+            return None
+        field, index, quoted, dquoted = m.groups()
+        steps.append(int(index) if index is not None else next(f for f in (field, quoted, dquoted) if f is not None))
+        pos = m.end()
+    return tuple(steps)
+
+def _lookup(value, steps):
+    for step in steps:
+        if isinstance(step, int):
+            if not isinstance(value, (list, tuple, str)) or not -len(value) <= step < len(value):
+                return []
+        elif not isinstance(value, dict) or step not in value:
+            return []
+        value = value[step]
+    return [value]
+
+def _simple_jsonpath(jpath):
+    steps = jsonpath_steps(jpath)
+    return None if steps is None else lambda value: _lookup(value, steps)
+
+@lru_cache(maxsize=1024)
+def compile_jsonpath(jpath : str):
+    ''' A function from a document to the values jpath matches in it. Simple paths skip
+    jsonpath_ng and become a chain of lookups. '''
+    find = _simple_jsonpath(jpath)
+    if find is None:
+        expr = parse_jsonpath(jpath)
+        find = lambda value: [match.value for match in expr.find(value)]
+    return find
+
+def _unwrap(out):
+    return out[0] if len(out) == 1 else out
 
 def jsonpath_query(json, jpath):
-    out = [match.value for match in parse_jsonpath(jpath).find(json)]
-    if len(out) == 1:
-        return out[0]
-    else:
-        return out
-    
+    return _unwrap(compile_jsonpath(jpath)(json))
+
+### STREAMING
+
+_STRUCTURAL = re.compile(r'["\\\[\]{}]')
+_SCALAR_END = re.compile(r'[\s,\]}]')
+_WHITESPACE = re.compile(r'\s*')
+
+class JsonStream:
+    ''' Reads a JSON document from an iterable of text chunks, going down simple paths
+    (see jsonpath_steps) and skipping everything else. Only the value matched is ever
+    parsed, and only it and the current chunk are held in memory. '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf, self.pos = '', 0
+        self.mark = None        # where the value being captured starts
+
+    def _fill(self):
+        chunk = next(self.chunks, '')
+        if not chunk:
+            return False
+        keep = self.pos if self.mark is None else self.mark
+        self.buf = self.buf[keep:] + chunk
+        self.pos -= keep
+        if self.mark is not None: self.mark = 0
+        return True
+
+    def peek(self):
+        ''' The next character that is not whitespace; '' at the end. '''
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if not self._fill(): return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars or not c:
+            raise ValueError(f'Malformed JSON: expected one of {chars!r}, got {c!r}.')
+        self.pos += 1
+        return c
+
+    def _scan(self, depth, in_string):
+        # moves past the end of the container (at depth) or the string being read
+        escaped = False
+        while True:
+            buf, i = self.buf, self.pos
+            while i < len(buf):
+                if escaped:
+                    escaped, i = False, i + 1
+                    continue
+                m = _STRUCTURAL.search(buf, i)
+                if m is None: break
+                c, i = m.group(), m.end()
+                if in_string:
+                    if c == '\\': escaped = True
+                    elif c == '"':
+                        in_string = False
+                        if depth == 0:
+                            self.pos = i
+                            return
+                elif c == '"': in_string = True
+                elif c in '[{': depth += 1
+                elif c in ']}':
+                    depth -= 1
+                    if depth == 0:
+                        self.pos = i
+                        return
+            self.pos = len(buf)
+            if not self._fill(): raise ValueError('Truncated JSON.')
+
+    def skip(self):
+        ''' Moves past the next value. '''
+        c = self.peek()
+        self.pos += 1
+        if c in '[{': self._scan(1, False)
+        elif c == '"': self._scan(0, True)
+        elif not c: raise ValueError('Truncated JSON.')
+        else:
+            while True:
+                m = _SCALAR_END.search(self.buf, self.pos)
+                if m is not None:
+                    self.pos = m.start()
+                    return
+                self.pos = len(self.buf)
+                if not self._fill(): return
+
+    def read(self):
+        ''' Parses the next value. '''
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip()
+            return json.loads(self.buf[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+    def find(self, steps):
+        ''' The values a path matches, as a list (as compile_jsonpath's functions return them). '''
+        for n, step in enumerate(steps):
+            c = self.peek()
+            if isinstance(step, str):
+                if c != '{': return []
+                self.pos += 1
+                while True:
+                    if self.peek() == '}': return []
+                    key = self.read()
+                    self.expect(':')
+                    if key == step: break
+                    self.skip()
+                    if self.expect(',}') == '}': return []
+            elif step >= 0 and c == '[':
+                self.pos += 1
+                for i in range(step + 1):
+                    if self.peek() == ']': return []
+                    if i == step: break
+                    self.skip()
+                    if self.expect(',]') == ']': return []
+            else:       # counting from the end, or into a string: needs the whole value
+                return _lookup(self.read(), steps[n:])
+        return [self.read()]
+
+
+CHUNK_SIZE = 64 * 1024
+
+def stream_local(path : dict, env : FileStorage, jpath):
+    ''' load_local, followed by a jsonpath query, without reading the whole file. '''
+    with env.load_resource(path['target'], 'r', encoding='utf-8') as fp:
+        return _unwrap(JsonStream(iter(lambda: fp.read(CHUNK_SIZE), '')).find(jsonpath_steps(jpath)))
+
+def stream_remote(http : dict, jpath, transport : Transport = None, limiter : RateLimiter = None):
+    ''' load_remote, followed by a jsonpath query, reading the response as it arrives.
+    Streamed responses are neither cached nor shared. As with load_remote, the body of an
+    error response is read like any other. '''
+    method, url, kwargs = _remote_request(http)
+    if limiter is not None:
+        limiter.acquire(urlsplit(url).hostname)
+    resp = (transport or default_transport()).request(method, url, stream=True, **kwargs)
+    try:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = (decoder.decode(chunk) for chunk in resp.iter_content(CHUNK_SIZE))
+        return _unwrap(JsonStream(chunks).find(jsonpath_steps(jpath)))
+    finally:
+        resp.close()
+
 ### CASTING
 def cast(type, raw):
     if type == 'json':
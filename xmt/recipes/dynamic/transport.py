@@ -0,0 +1,173 @@
+import os
+import json
+import tempfile
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Transport:
+    ''' Issues the requests of http sources. Connections are pooled per host and kept alive,
+    and every request gets a timeout and a retry policy with exponential backoff. '''
+    def __init__(self, timeout = 30, retries = 3, backoff = 0.5, pool_connections = 10, pool_maxsize = 10,
+                 retry_statuses = (429, 500, 502, 503, 504)):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections = pool_connections,
+            pool_maxsize = pool_maxsize,
+            max_retries = Retry(total = retries, backoff_factor = backoff, status_forcelist = retry_statuses,
+                                raise_on_status = False)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    async def arequest(self, method, url, **kwargs) -> requests.Response:
+        ''' The same, for use from an asyncio loop; requests run on its default executor. '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self.request(method, url, **kwargs))
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+    def __deepcopy__(self, memo):
+        return self         # connections are shared, not state
+
+
+_default = None
+
+def default_transport() -> Transport:
+    ''' The transport shared by every recipe whose storage does not set its own. '''
+    global _default
+    if _default is None:
+        _default = Transport()
+    return _default
+
+
+CREDENTIAL_HEADERS = ('authorization', 'proxy-authorization', 'cookie', 'set-cookie')
+
+def carries_credentials(headers) -> bool:
+    ''' Whether request or response headers hold credentials, or set them. '''
+    return any(name.lower() in CREDENTIAL_HEADERS for name in (headers or {}))
+
+
+class ResponseCache:
+    ''' A disk-backed cache of http responses, keyed by method, URL, headers and body.
+    Each entry is a body file and a JSON metadata file (time stored, ETag, Last-Modified,
+    Content-Type; no other header is kept). Files are written aside and moved into place,
+    readable by the owner only. Bodies are evicted least-recently-used first once they
+    take more than max_bytes. '''
+    def __init__(self, path, max_bytes = 64 * 2 ** 20):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.revalidations = 0
+        self._lock = threading.Lock()
+        self._entries = None     # key -> size, in LRU order; read from disk on first use
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def key(method, url, headers = None, data = None):
+        raw = json.dumps([method.upper(), url, sorted((headers or {}).items()), data], default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def _write(self, key, ext, data: bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp: fp.write(data)
+            os.replace(tmp, self._file(key, ext))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _index(self):
+        if self._entries is None:
+            found = []
+            for name in os.listdir(self.path):
+                if name.endswith('.json'):
+                    key = name[:-len('.json')]
+                    try: found.append((os.path.getmtime(self._file(key, '.json')), key,
+                                       os.path.getsize(self._file(key, '.body'))))
+                    except OSError: continue
+            self._entries = OrderedDict((key, size) for _, key, size in sorted(found))
+        return self._entries
+
+    def get(self, key):
+        ''' Returns (metadata, body) for a key, or None. '''
+        with self._lock:
+            if key not in self._index(): return None
+            try:
+                with open(self._file(key, '.json'), 'r', encoding='utf-8') as fp: meta = json.load(fp)
+                with open(self._file(key, '.body'), 'rb') as fp: body = fp.read()
+            except (OSError, ValueError):
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return meta, body
+
+    def put(self, key, body: bytes, headers = None):
+        headers = headers or {}
+        meta = {
+            'stored': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'content_type': headers.get('Content-Type', ''),
+        }
+        with self._lock:
+            self._write(key, '.body', body)      # the metadata last: it makes the entry
+            self._write(key, '.json', json.dumps(meta).encode('utf-8'))
+            entries = self._index()
+            entries[key] = len(body)
+            entries.move_to_end(key)
+            total = sum(entries.values())
+            while total > self.max_bytes and len(entries) > 1:
+                old, size = entries.popitem(last=False)
+                total -= size
+                for ext in ('.json', '.body'):
+                    try: os.remove(self._file(old, ext))
+                    except OSError: pass
+        return meta
+
+    def touch(self, key, meta):
+        ''' Marks an entry as fresh again, after a successful revalidation. '''
+        meta['stored'] = time.time()
+        with self._lock:
+            self._write(key, '.json', json.dumps(meta).encode('utf-8'))
+
+    def record(self, outcome):
+        ''' Counts a lookup: 'hits', 'misses' or 'revalidations'. '''
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations,
+                'entries': len(self._index()), 'bytes': sum(self._index().values())}
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+_default_cache = None
+
+def default_cache() -> ResponseCache:
+    ''' The response cache used when a var asks for caching and its storage sets none. '''
+    global _default_cache
+    if _default_cache is None:
+        root = os.environ.get('XDG_CACHE_HOME', os.path.join('~', '.cache'))
+        _default_cache = ResponseCache(os.path.join(root, 'xmt', 'http'))
+    return _default_cache
@@ -1,23 +1,40 @@
-from collections import defaultdict
+import os
+import tempfile
+from bisect import bisect_left
 
 from pypdf import parse_filename_page_ranges
-from .parsing import parse_index_string
+from .parsing import parse_index_string, compile_query
 from ..base import Recipe, ParsingError
 from ..storage import Spec, RecipeStorage
-from .processor import ContentWrapper, IndexCollection
+from .processor import ContentStore, ContentView, MappedLines, IndexCollection, IndexRanges, INDEX_BACKENDS
+from .processor import read_artifact, write_artifact, SearchIndex, AliasTable, tokenize, MISSING
 
 # TODO:
 #   1. VALIDATION
 #   2. A script that generates the YAML files.
 
 
+def _tuplify(value):
+    # JSON turns the tuples in versions into lists
+    return tuple(map(_tuplify, value)) if isinstance(value, list) else value
+
+def _current_version(env: RecipeStorage, dep):
+    # resources are recorded as ('resource', path), recipes by name
+    return env.resource_version(dep[1]) if isinstance(dep, tuple) else env.version(dep)
+
+
 class StaticRecipe(Recipe):
     def __init__(self, spec: Spec, env: RecipeStorage, stack: list = None):
         super().__init__(spec, env, stack)
+        try:
+            self.index_class = INDEX_BACKENDS[self.spec['metadata'].get('index', 'list')]
+        except KeyError:
+            raise ParsingError(f"Unknown index backend {self.spec['metadata']['index']}.")
+        self.searchable = bool(self.spec['metadata'].get('search', False))
         self.initialize()
 
     def initialize(self):
-        self.content = []
+        self.content = ContentStore()
 
         if "tags" not in self.spec or not self.spec["tags"]:
             self.spec["tags"] = {}
@@ -27,28 +44,116 @@ class StaticRecipe(Recipe):
         self._tags = {}
         self._special_tags = []
         self.tags = None
+        self.versions = {}      # source versions of every included recipe and resource
+        self.search_index = SearchIndex() if self.searchable else None
+        self._alias_tables = {}     # (tag name, or None for all lines, weight column) -> (column version, AliasTable)
+
+    @classmethod
+    def load(cls, name, env: RecipeStorage, stack: list = None):
+        """Returns the executed static recipe called name. The execution is cached
+        in env, and reused for as long as neither it nor its includes change."""
+        cached = env.cache.get(name)
+        if cached is not None and all(_current_version(env, dep) == version
+                                      for dep, version in cached.versions.items()):
+            env.cache.record('hits')
+            return cached
+        env.cache.record('misses')
+
+        recipe = cls.load_artifact(name, env, stack)
+        if recipe is None:
+            recipe = cls(env.load_recipe(name), env, list(stack or []))
+            recipe.execute()
+            recipe.versions[name] = env.version(name)
+        if None in recipe.versions.values():
+            env.cache.discard(name)
+        else:
+            env.cache.put(name, recipe)
+        return recipe
+
+    @classmethod
+    def load_artifact(cls, name, env: RecipeStorage, stack: list = None):
+        """Restores the executed recipe from its compiled form (see save), if env has one
+        and nothing it was compiled from has changed since. Returns None otherwise."""
+        buffer = env.load_artifact(name)
+        if buffer is None:
+            return None
+        try:
+            header, lines = read_artifact(buffer)
+        except ValueError:      # not a compiled recipe, or a truncated one: as good as none
+            if hasattr(buffer, 'close'): buffer.close()
+            return None
+        versions = {_tuplify(dep): _tuplify(version) for dep, version in header['versions']}
+        if any(_current_version(env, dep) != version for dep, version in versions.items()):
+            lines.close()
+            return None
+
+        recipe = cls(Spec(header['spec']), env, list(stack or []))
+        recipe._source = name       # the content is left out of the spec
+        recipe.content.extend_lines(lines)
+        for ann, column in header['annotations'].items():
+            nulls = set(header.get('nulls', {}).get(ann, ()))      # None is written for MISSING as well
+            recipe.content.columns[ann] = [MISSING if value is None and i not in nulls else value
+                                           for i, value in enumerate(column)]
+        recipe._tags = {tag: IndexRanges([range(*r) for r in ranges]) for tag, ranges in header['tags'].items()}
+        recipe.compile_tags()
+        recipe.versions = versions
+        if header.get('search') is not None:
+            recipe.search_index = SearchIndex.mapped(lines, header['search'])
+        return recipe
+
+    def save(self, path):
+        """Writes the executed state (content, tags and annotations) to a compiled form
+        that load_artifact maps back in without running the recipe again.
+        Content is stored as text, or as JSON if any line is not a str; annotations must
+        be JSON-serializable."""
+        header = {
+            'spec': {k: v for k, v in self.spec.items() if k != 'content'},
+            'count': len(self),
+            'values': not self.content.columns['content'].is_text(),
+            'tags': {tag: [[r.start, r.stop, r.step] for r in what.ranges] for tag, what in self._tags.items()},
+            'annotations': {ann: [None if value is MISSING else value for value in column]
+                            for ann, column in self.content.columns.items() if ann != 'content'},
+            'nulls': {ann: [i for i, value in enumerate(column) if value is None]
+                      for ann, column in self.content.columns.items() if ann != 'content'},
+            'versions': [[dep, version] for dep, version in self.versions.items()],
+        }
+        # written aside and moved into place, so a failure (say, an annotation JSON cannot
+        # hold) never leaves a partial artifact behind
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                write_artifact(fp, header, self.content.columns['content'], len(self),
+                               self.search_index.postings if self.search_index is not None else None)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
 
     def include(self, path):
         """Handles the inclusion of a static recipe."""
-        subrecipe = StaticRecipe(self.env.load_recipe(path), self.env, self.stack)
-        subrecipe.execute(compile_tags=False)
+        subrecipe = StaticRecipe.load(path, self.env, self.stack)
+        self.versions.update(subrecipe.versions)
 
         precount = len(self)
 
-        for chunk in subrecipe.content:
-            self.content.append(chunk)
+        self.content.extend(subrecipe.content)
+        if self.searchable:
+            if subrecipe.search_index is not None:
+                self.search_index.extend(subrecipe.search_index, precount)
+            else:
+                self.search_index.add_lines(precount + 1, subrecipe.content.columns['content'])
 
         for tag, what in subrecipe._tags.items():
-            if tag in self.spec["tags"]:
-                if isinstance(self.spec["tags"][tag], str):
-                    self.spec["tags"][tag] = parse_index_string(
-                        self.spec["tags"][tag], precount
-                    )
-            else:
-                self.spec['tags'][tag] = []
-            self.spec["tags"][tag].extend([
-                precount + i for i in what
-            ])  # HACK: Modifying the spec itself!
+            self.process_tag(tag, what.shift(precount))
+
+    def include_file(self, path, encoding='utf-8'):
+        """Handles a file marker: the lines of a resource, memory-mapped and decoded on access."""
+        with self.env.load_resource(path, 'rb') as fp:
+            lines = MappedLines.from_file(fp, encoding)
+        if self.searchable:
+            self.search_index.add_lines(len(self) + 1, lines)
+        self.content.extend_lines(lines)
+        self.versions[('resource', path)] = self.env.resource_version(path)
 
     def process_content(self):
         """Iterates through the 'include' section, including every recipe."""
@@ -56,21 +161,25 @@ class StaticRecipe(Recipe):
             if isinstance(item, dict):
                 if 'include' in item:
                     self.include(item['include'])
+                elif 'file' in item:
+                    self.include_file(item['file'], item.get('encoding', 'utf-8'))
                 elif 'tag' in item:
                     self._special_tags.append((len(self.content), item))
                 else:
                     raise ParsingError('Unrecognized special content marker.')
                 continue
 
-            self.content.append(defaultdict(None, {"content": item}))
+            self.content.append(item)
+            if self.searchable:
+                self.search_index.add(len(self), item)
 
     def process_tag(self, tag, what):
-        if tag not in self._tags:
-            self._tags[tag] = []
         if isinstance(what, str):
             what = parse_index_string(what, len(self))
-        elif isinstance(what, int): what = [what]
-        self._tags[tag].extend(what)
+        elif isinstance(what, int): what = IndexRanges([range(what, what + 1)])
+        elif not isinstance(what, IndexRanges): what = IndexRanges.from_indices(what)
+
+        self._tags[tag] = self._tags[tag] | what if tag in self._tags else what
 
     def process_tags(self):
         """Handles the 'tags' section."""
@@ -84,19 +193,13 @@ class StaticRecipe(Recipe):
                 tag_name = special['with']
             except KeyError:
                 raise ParsingError('Malformed special tag marker.')
-            
-            if not tag_name in self._tags:
-                self._tags[tag_name] = []
 
             if what == 'preceding':
-                self._tags[tag_name].extend(range(1, i + 1))
+                self.process_tag(tag_name, IndexRanges([range(1, i + 1)]))
             elif what == 'subsequent':
-                self._tags[tag_name].extend(range(max(1, i), len(self)+1))
+                self.process_tag(tag_name, IndexRanges([range(max(1, i), len(self) + 1)]))
             else:
                 raise ParsingError(f'Invalid special marker {what}')
-            
-        for tag_name, indices in self._tags.items():
-            indices.sort()
 
 
     def process_annotations(self):
@@ -110,12 +213,12 @@ class StaticRecipe(Recipe):
                         if "jump" in pick:  # TODO: Handle and TEST jumping
                             rpos = pick["jump"]
                     else:
-                        self.content[rpos][ann] = pick
+                        self.content.annotate(ann, rpos, pick)
                     cpos += 1
                     rpos += 1
             elif isinstance(val, dict):
                 for ind, annval in val.items():
-                    self.content[ind][ann] = annval
+                    self.content.annotate(ann, ind, annval)
             else:
                 raise ParsingError("Could not process annotation.")
 
@@ -123,10 +226,13 @@ class StaticRecipe(Recipe):
         """Optimize the tags for fast access and filtering"""
         self.tags = {}
         for tag, indices in self._tags.items():
-            self.tags[tag] = IndexCollection(indices, len(self), tag)
+            self.tags[tag] = self.index_class(indices, len(self), tag)
 
     def execute(self, compile_tags=True):
         """Executes the recipe, making it ready for consumption."""
+        if 'content' not in self.spec:     # restored from a compiled form
+            self.spec = self.env.load_recipe(self._source)
+
         # First, clear the state
         self.initialize()
 
@@ -137,13 +243,100 @@ class StaticRecipe(Recipe):
             self.compile_tags()
         self.process_annotations()
 
+    def query(self, expr):
+        """Filter by a tag query, like 'a & ~b | (c - d)'. Returns an IndexCollection."""
+        return self._evaluate(compile_query(expr))
+
+    def _evaluate(self, plan):
+        kind = plan[0]
+        if kind == 'tag':
+            return self.tags[plan[1]]
+        elif kind == 'not':
+            return ~self._evaluate(plan[1])
+        elif kind == 'or':
+            result = self._evaluate(plan[1][0])
+            for term in plan[1][1:]:
+                result = result | self._evaluate(term)
+            return result
+
+        # intersect smallest-first, so every intermediate is as small as it gets
+        positives = sorted((self._evaluate(term) for term in plan[1]), key=len)
+        result = positives[0]
+        for term in positives[1:]:
+            if not result: return result
+            result = result & term
+        for term in plan[2]:
+            if not result: return result
+            result = result - self._evaluate(term)
+        return result
+
+    def search(self, terms):
+        """Lines containing every word in terms, as an IndexCollection.
+        Requires the recipe to be searchable (metadata.search)."""
+        if self.search_index is None:
+            raise ParsingError(f'Recipe {self.id} is not searchable; set search: true in its metadata.')
+        postings = sorted((self.search_index.lookup(token) for token in set(tokenize(terms))), key=len)
+        if not postings:
+            return self.index_class([], len(self), terms)
+        result = self.index_class(list(postings[0]), len(self), terms)     # never the postings themselves
+        for indices in postings[1:]:
+            if not result: break
+            result = result & self.index_class(indices, len(self))
+        result.name = terms
+        return result
+
+    def where(self, **conditions):
+        """Lines whose annotations match every condition, as an IndexCollection.
+        where(author='X') matches a value; where(year=slice(1900, 2000)) matches
+        numeric values in a half-open range (either end may be None)."""
+        if not conditions:
+            return self.index_class(IndexRanges([range(1, len(self) + 1)]), len(self))
+        matches = sorted((self._where(name, value) for name, value in conditions.items()), key=len)
+        result = matches[0]
+        for indices in matches[1:]:
+            if not result: break
+            result = result & indices
+        result.name = ', '.join(f'{name}={value!r}' for name, value in conditions.items())
+        return result
+
+    def _where(self, name, value):
+        if not isinstance(value, slice):
+            return self.index_class(self.content.value_index(name).get(value, []), len(self))
+        values, indices = self.content.sorted_index(name)
+        lo = 0 if value.start is None else bisect_left(values, value.start)
+        hi = len(values) if value.stop is None else bisect_left(values, value.stop)
+        return self.index_class(sorted(indices[lo:hi]), len(self))
+
+    def sample(self, what = None, k = 1, weights = None, seed = None, replace = True):
+        """Draws k random lines from a tag (by name), an IndexCollection, or the whole recipe.
+        weights names a numeric annotation; the alias table it needs is built once per
+        (tag, annotation) and reused until the annotation changes, for tags and the whole
+        recipe (other collections build theirs on every call). Returns the drawn lines as a ContentView."""
+        if what is None:
+            collection = self.index_class(IndexRanges([range(1, len(self) + 1)]), len(self))
+        else:
+            collection = self.tags[what] if isinstance(what, str) else what
+        if weights is not None:
+            key = (what, weights) if what is None or isinstance(what, str) else None
+            version = self.content.version(weights)
+            cached = self._alias_tables.get(key) if key is not None else None
+            table = cached[1] if cached is not None and cached[0] == version else None
+            if table is None:
+                column = self.content.columns.get(weights, [])
+                table = AliasTable([(column[i - 1] if i <= len(column) else None) or 0 for i in collection])
+                if key is not None: self._alias_tables[key] = (version, table)
+            weights = table
+        return ContentView(self.content, collection.sample(k, weights, seed, replace), -1)
+
     def __getitem__(self, i):
-        if isinstance(i, int) or isinstance(i, slice):
-            return ContentWrapper(self.content[i])
+        if isinstance(i, int):
+            return self.content[i]
+        elif isinstance(i, slice):
+            return ContentView(self.content, range(*i.indices(len(self))))
         elif isinstance(i, str):
             return self.tags[i]
         elif isinstance(i, IndexCollection):
-            return [self[j - 1] for j in i.indices]
+            return ContentView(self.content, i, -1)
         else:
             raise TypeError(f"Slicing is not supported for type {type(i)}")
 
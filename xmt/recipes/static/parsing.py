@@ -1,6 +1,7 @@
-def process_raw(L: list):
-    """Returns a duplicate-free version of L"""
-    return list(set(L))         # will be sorted later. 
+import re
+from functools import lru_cache
+
+from .processor import IndexRanges
 
 def _process_index(i, total_len):
     if i == 0:
@@ -25,15 +26,14 @@ def _process_endpoints(start, end, total_len):
 
 
 def parse_index_string(s, total_len):
-    """Parse an index string, like 0..3;4,5 or 1,-1"""
+    """Parse an index string, like 0..3;4,5 or 1,-1, into IndexRanges"""
+    return IndexRanges(_parse_ranges(s, total_len))
+
+
+def _parse_ranges(s, total_len):
     # recursive branch
     if ";" in s:
-        return process_raw(
-            sum(
-                [parse_index_string(subs.strip(), total_len) for subs in s.split(";")],
-                start=[],
-            )
-        )
+        return [r for subs in s.split(";") for r in _parse_ranges(subs.strip(), total_len)]
 
     # simple branch
     if ".." in s:  # a range
@@ -52,11 +52,135 @@ def parse_index_string(s, total_len):
         a, b = _process_endpoints(int(a.strip()), int(b.strip()), total_len)
         step = int(step)
 
-        return list(range(a, b + 1, step))
+        return [range(a, b + 1, step)]
 
     elif "," in s:  # a comma-separated list
-        return process_raw([
-            _process_index(int(c.strip()), total_len) for c in s.split(",")
-        ])
+        return [range(i, i + 1) for i in (_process_index(int(c.strip()), total_len) for c in s.split(","))]
     else:  # a singleton
-        return [_process_index(int(s.strip()), total_len)]
+        i = _process_index(int(s.strip()), total_len)
+        return [range(i, i + 1)]
+
+
+
+### TAG QUERIES
+
+class QuerySyntaxError(ValueError): pass
+
+# A hyphen inside a word (e.g. special-next) is part of the tag name;
+# the difference operator has to stand on its own.
+_QUERY_TOKEN = re.compile(r"""\s*(?:
+    (?P<quoted>"[^"]*"|'[^']*')|
+    (?P<name>[^\s&|~()\-"']+(?:-[^\s&|~()\-"']+)*)|
+    (?P<op>[&|~()\-])
+)""", re.VERBOSE)
+
+
+def tokenize_query(s):
+    """Split a tag query into ('name', tag) and ('op', symbol) tokens."""
+    tokens, pos = [], 0
+    s = s.rstrip()
+    while pos < len(s):
+        m = _QUERY_TOKEN.match(s, pos)
+        if not m:
+            raise QuerySyntaxError(f'Unexpected character at position {pos} in {s!r}.')
+        if m.group('quoted'):
+            tokens.append(('name', m.group('quoted')[1:-1]))
+        elif m.group('name'):
+            tokens.append(('name', m.group('name')))
+        else:
+            tokens.append(('op', m.group('op')))
+        pos = m.end()
+    return tokens
+
+
+def parse_query(s):
+    """Parse a tag query, like a & ~b | (c - d), into a syntax tree.
+
+    Precedence mirrors the Python operators on IndexCollection:
+    ~ binds tightest, then -, then &, then |."""
+    tokens = tokenize_query(s)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else (None, None)
+
+    def take(op):
+        nonlocal pos
+        if peek() == ('op', op):
+            pos += 1
+            return True
+        return False
+
+    def binary(op, operand, node):
+        def rule():
+            left = operand()
+            while take(op):
+                left = node(left, operand())
+            return left
+        return rule
+
+    def atom():
+        nonlocal pos
+        kind, value = peek()
+        if kind == 'name':
+            pos += 1
+            return ('tag', value)
+        if take('~'):
+            return ('not', atom())
+        if take('('):
+            inner = union()
+            if not take(')'):
+                raise QuerySyntaxError(f'Unbalanced parentheses in {s!r}.')
+            return inner
+        raise QuerySyntaxError(f'Unexpected token {value!r} in {s!r}.')
+
+    difference = binary('-', atom, lambda a, b: ('sub', a, b))
+    intersection = binary('&', difference, lambda a, b: ('and', (a, b)))
+    union = binary('|', intersection, lambda a, b: ('or', (a, b)))
+
+    tree = union()
+    if pos != len(tokens):
+        raise QuerySyntaxError(f'Trailing input {tokens[pos][1]!r} in {s!r}.')
+    return tree
+
+
+def optimize_query(node):
+    """Rewrite a query tree into a plan that avoids materializing complements.
+
+    Differences become intersections with negated terms, intersections and
+    unions are flattened, and every intersection is turned into
+    ('and', positives, negatives), evaluated as the intersection of the
+    positives minus the union of the negatives. A bare complement is only
+    kept when an intersection has no positive term at all."""
+    kind = node[0]
+    if kind == 'tag':
+        return node
+    if kind == 'not':
+        inner = optimize_query(node[1])
+        return inner[1] if inner[0] == 'not' else ('not', inner)
+    if kind == 'or':
+        terms = []
+        for term in map(optimize_query, node[1]):
+            terms.extend(term[1] if term[0] == 'or' else [term])
+        return ('or', tuple(terms))
+
+    terms = [node[1], ('not', node[2])] if kind == 'sub' else node[1]
+    positives, negatives = [], []
+    for term in map(optimize_query, terms):
+        if term[0] == 'and':
+            positives.extend(term[1])
+            negatives.extend(term[2])
+        elif term[0] == 'not':
+            negatives.append(term[1])
+        else:
+            positives.append(term)
+    if not positives:
+        # De Morgan: ~a & ~b == ~(a | b), a single complement
+        return ('not', negatives[0] if len(negatives) == 1 else ('or', tuple(negatives)))
+    return ('and', tuple(positives), tuple(negatives))
+
+
+@lru_cache(maxsize=256)
+def compile_query(s):
+    """Parse and optimize a tag query. Plans are cached by query string."""
+    return optimize_query(parse_query(s))
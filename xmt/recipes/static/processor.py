@@ -1,15 +1,213 @@
+import os
+import re
+import mmap
+import random
+import json
+import struct
+from array import array
+from collections.abc import Mapping, Sequence
+from bisect import bisect_right
+from heapq import merge
+from itertools import accumulate, chain
+
+
+class IndexRanges:
+    ''' A sorted union of ranges, standing in for a list of indices.
+    Nothing is expanded until the indices are iterated over. '''
+    __slots__ = ('ranges', 'disjoint', '_starts', '_len', '_cumulative', '_expanded')
+
+    def __init__(self, ranges = ()):
+        self.ranges = self._normalize(ranges)
+        # with disjoint spans, iteration is a plain chain and lookups a bisect
+        self.disjoint = all(prev[-1] < r.start for prev, r in zip(self.ranges, self.ranges[1:]))
+        self._starts = [r.start for r in self.ranges]
+        # only stepped ranges with different steps can still share indices
+        stepped = sorted((r for r in self.ranges if r.step != 1), key=lambda r: r.start)
+        shared = any(prev[-1] >= r.start for prev, r in zip(stepped, stepped[1:]))
+        self._len = None if shared else sum(map(len, self.ranges))
+        self._cumulative = None
+        self._expanded = None   # the indices as a list, for lookups over overlapping ranges
+
+    @staticmethod
+    def _normalize(ranges):
+        ''' Merge overlapping runs, clip stepped ranges to the gaps between runs and
+        merge stepped ranges of the same step and phase, in O(k log k). '''
+        ranges = [r if len(r) > 1 else range(r.start, r.start + 1) for r in ranges if len(r)]
+
+        runs = []
+        for r in sorted((r for r in ranges if r.step == 1), key=lambda r: r.start):
+            if runs and r.start <= runs[-1].stop:
+                runs[-1] = range(runs[-1].start, max(runs[-1].stop, r.stop))
+            else:
+                runs.append(r)
+        run_starts = [r.start for r in runs]
+
+        pieces = []
+        for r in (r for r in ranges if r.step != 1):
+            start = r.start
+            for run in runs[max(bisect_right(run_starts, start) - 1, 0):]:
+                if run.start > r[-1]: break
+                if run.stop <= start: continue
+                pieces.append(range(start, min(run.start, r.stop), r.step))
+                start += -(-(run.stop - start) // r.step) * r.step     # first one past the run
+            pieces.append(range(start, r.stop, r.step))
+
+        stepped = []
+        for r in sorted((r for r in pieces if len(r)), key=lambda r: (r.step, r.start % r.step, r.start)):
+            prev = stepped[-1] if stepped else None
+            if prev and prev.step == r.step and (r.start - prev.start) % r.step == 0 \
+                    and r.start <= prev[-1] + r.step:
+                stepped[-1] = range(prev.start, max(prev.stop, r.stop), r.step)
+            else:
+                stepped.append(r)
+
+        # clipping leaves single indices, which may still be in another stepped range (and then
+        # are dropped, so lengths add up) or in one another
+        multi = [r for r in stepped if len(r) > 1]
+        singles = sorted({r.start for r in stepped if len(r) == 1})
+        singles = [range(i, i + 1) for i in singles if not any(i in r for r in multi)]
+        return sorted(runs + multi + singles, key=lambda r: r.start)
+
+    @classmethod
+    def from_indices(cls, indices):
+        ''' Compress an iterable of indices into runs. '''
+        ranges, start, last = [], None, None
+        for i in sorted(set(indices)):
+            if start is not None and i == last + 1:
+                last = i
+                continue
+            if start is not None:
+                ranges.append(range(start, last + 1))
+            start = last = i
+        if start is not None:
+            ranges.append(range(start, last + 1))
+        return cls(ranges)
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+    def __iter__(self):
+        if self.disjoint:
+            return chain.from_iterable(self.ranges)
+        return self._iter_merged()
+
+    def _iter_merged(self):
+        last = None
+        for i in merge(*self.ranges):
+            if i != last:
+                yield i
+                last = i
+
+    def __getitem__(self, k):
+        ''' The k-th smallest index, found by bisection over the ranges when they are disjoint. '''
+        if not self.disjoint:
+            if self._expanded is None:
+                self._expanded = list(self)
+            return self._expanded[k]
+        if self._cumulative is None:
+            self._cumulative = list(accumulate(map(len, self.ranges), initial=0))
+        if k < 0: k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('IndexRanges index out of range.')
+        pos = bisect_right(self._cumulative, k) - 1
+        return self.ranges[pos][k - self._cumulative[pos]]
+
+    def __contains__(self, i):
+        if self.disjoint:
+            pos = bisect_right(self._starts, i) - 1
+            return pos >= 0 and i in self.ranges[pos]
+        return any(i in r for r in self.ranges)
+
+    def __or__(self, other):
+        return IndexRanges(self.ranges + other.ranges)
+
+    def shift(self, offset):
+        return IndexRanges([range(r.start + offset, r.stop + offset, r.step) for r in self.ranges])
+
+    def complement(self, total_len):
+        ''' The indices in 1..total_len not in this collection, or None if that needs expanding. '''
+        if not self.disjoint or any(r.step != 1 for r in self.ranges):
+            return None
+        gaps, start = [], 1
+        for r in self.ranges:
+            gaps.append(range(start, min(r.start, total_len + 1)))
+            start = r.stop
+        gaps.append(range(start, total_len + 1))
+        return IndexRanges(gaps)
+
+    def __eq__(self, other):
+        if isinstance(other, IndexRanges):
+            return self.ranges == other.ranges or list(self) == list(other)
+        return list(self) == list(other)
+
+    def __repr__(self):
+        parts = [f'{r.start}' if len(r) == 1 else f'{r.start}..{r[-1]}' + (f'/{r.step}' if r.step != 1 else '')
+                 for r in self.ranges]
+        return f"IndexRanges('{';'.join(parts)}')"
+
+
 class IndexCollection:
     ''' Essentially a list of indices, with fast set operations. '''
     def __init__(self, indices, total_len, name = None):
         self.name = name
-        self.indices = indices
-        self.indices_set = set(indices) # for faster inversion
         self.total_len = total_len
+        self._indices_set = None
+        # IndexRanges are kept as they are, and only expanded when needed
+        self._ranges = indices if isinstance(indices, IndexRanges) else None
+        self._indices = None if self._ranges is not None else indices
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            self._indices = list(self._ranges)
+        return self._indices
+
+    @property
+    def indices_set(self):
+        if self._indices_set is None:     # only built when inverting
+            self._indices_set = set(self.indices)
+        return self._indices_set
+
+    def __len__(self):
+        return len(self._ranges) if self._indices is None else len(self.indices)
+
+    def __iter__(self):
+        return iter(self._ranges) if self._indices is None else iter(self.indices)
 
-    def __len__(self): return len(self.indices)
-    def __repr__(self): return f'IndexCollection({self.name}, with {len(self.indices)} indices)'
+    def __contains__(self, i):
+        return i in self._ranges if self._indices is None else i in self.indices_set
+    def __repr__(self): return f'{type(self).__name__}({self.name}, with {len(self)} indices)'
     def __str__(self): return self.__repr__()
 
+    def __getitem__(self, k):
+        return self._ranges[k] if self._indices is None else self.indices[k]
+
+    def sample(self, k = 1, weights = None, seed = None, replace = True):
+        ''' Draws k indices, uniformly or by weight, without expanding range-backed collections.
+        weights is either a column (weights[i - 1] weighs index i) or a prebuilt AliasTable.
+        Sampling without replacement is uniform only. '''
+        rng = random.Random(seed) if seed is not None else random
+        if not replace:
+            if weights is not None:
+                raise ValueError('Weighted sampling is only supported with replacement.')
+            return [self[rank] for rank in rng.sample(range(len(self)), k)]
+        if weights is None:
+            n = len(self)
+            if not n: raise IndexError('Cannot sample from an empty collection.')
+            return [self[rng.randrange(n)] for _ in range(k)]
+        if not isinstance(weights, AliasTable):
+            weights = AliasTable([weights[i - 1] or 0 for i in self])
+        return [self[weights.draw(rng)] for _ in range(k)]
+
+    def to_list(self):
+        return self
+
+    def to_bitmap(self):
+        return BitmapIndexCollection(self._ranges if self._indices is None else self.indices,
+                                     self.total_len, self.name)
+
     def __and__(self, other):
         result = []
         # use two pointers to find intersectiono
@@ -59,11 +257,16 @@ class IndexCollection:
                 i += 1
             else:
                 j += 1
+        result += self.indices[i:]
         return IndexCollection(result, min(self.total_len, other.total_len),
                                f'({self.name} - {other.name})' if self.name and other.name else None)
     
     # define the minus sign to be a complement
     def __invert__(self):
+        if self._indices is None:
+            gaps = self._ranges.complement(self.total_len)
+            if gaps is not None:
+                return IndexCollection(gaps, self.total_len, f'~{self.name}')
         result = []
         for i in range(1, self.total_len + 1):
             if i not in self.indices_set:
@@ -77,15 +280,523 @@ class IndexCollection:
     def __hash__(self):
         return hash((tuple(self.indices), self.total_len, self.name))
     
-        
-class ContentWrapper(dict):
-    def __init__(self, content: dict):
-        super().__init__(**content)
+
+
+# bit positions set in each byte value, for fast bitmap -> list conversion
+_BYTE_BITS = [tuple(b for b in range(8) if v >> b & 1) for v in range(256)]
+
+class BitmapIndexCollection(IndexCollection):
+    ''' An IndexCollection backed by a packed bitset: bit i is set iff index i is present.
+    Set operations, complement and len run on the underlying big integer. '''
+    def __init__(self, indices, total_len, name = None):
+        self.name = name
+        self.total_len = total_len
+        self._indices = None
+        if isinstance(indices, int):
+            self.bits = indices
+            return
+
+        runs = []
+        if isinstance(indices, IndexRanges):    # whole runs are set at once
+            runs = [r for r in indices.ranges if r.step == 1]
+            indices = chain.from_iterable(r for r in indices.ranges if r.step != 1)
+        buf = bytearray(total_len // 8 + 1)
+        for i in indices:
+            buf[i >> 3] |= 1 << (i & 7)
+        self.bits = int.from_bytes(buf, 'little')
+        for r in runs:
+            self.bits |= (1 << r.stop) - (1 << r.start)
+
+    @property
+    def indices(self):
+        ''' The sorted-list form, built on first access. '''
+        if self._indices is None:
+            data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+            self._indices = [pos << 3 | b for pos, byte in enumerate(data) if byte
+                             for b in _BYTE_BITS[byte]]
+        return self._indices
+
+    def _other_bits(self, other):
+        return other.bits if isinstance(other, BitmapIndexCollection) else other.to_bitmap().bits
+
+    def _combine(self, bits, total_len, name):
+        return BitmapIndexCollection(bits, total_len, name)
+
+    def __len__(self): return self.bits.bit_count()
+    def __iter__(self): return iter(self.indices)
+    def __getitem__(self, k): return self.indices[k]
+    def __bool__(self): return self.bits != 0
+    def __contains__(self, i): return i > 0 and self.bits >> i & 1 == 1
+
+    def __and__(self, other):
+        return self._combine(self.bits & self._other_bits(other), min(self.total_len, other.total_len),
+                             f'({self.name} & {other.name})' if self.name and other.name else None)
+
+    def __or__(self, other):
+        return self._combine(self.bits | self._other_bits(other), max(self.total_len, other.total_len),
+                             f'({self.name} | {other.name})' if self.name and other.name else None)
+
+    def __sub__(self, other):
+        return self._combine(self.bits & ~self._other_bits(other), min(self.total_len, other.total_len),
+                             f'({self.name} - {other.name})' if self.name and other.name else None)
+
+    def __invert__(self):
+        mask = (1 << (self.total_len + 1)) - 2     # bits 1..total_len
+        return self._combine(self.bits ^ mask, self.total_len, f'~{self.name}')
+
+    def __eq__(self, other):
+        if isinstance(other, BitmapIndexCollection):
+            return self.bits == other.bits
+        return super().__eq__(other)
+
+    __hash__ = IndexCollection.__hash__
+
+    def to_list(self):
+        return IndexCollection(self.indices, self.total_len, self.name)
+
+    def to_bitmap(self):
+        return self
+
+
+class AliasTable:
+    ''' Vose's alias method: O(n) to build, O(1) per weighted draw of a rank in range(n). '''
+    __slots__ = ('prob', 'alias')
+
+    def __init__(self, weights):
+        n, total = len(weights), sum(weights)
+        if not n or total <= 0:
+            raise ValueError('Weights must include at least one positive value.')
+        scaled = [w * n / total for w in weights]
+        self.prob, self.alias = [1.0] * n, list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+
+    def __len__(self): return len(self.prob)
+
+    def draw(self, rng = random):
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+INDEX_BACKENDS = {
+    'list': IndexCollection,
+    'bitmap': BitmapIndexCollection
+}
+
+INDEX_MAGIC = b'XMTIDX1\n'
+INDEX_EXT = '.idx'
+
+class MappedLines(Sequence):
+    ''' The lines of a memory-mapped file, decoded one at a time on access.
+    offsets holds the start of every line, followed by the end of the last one.
+    source is the mmap the lines live in, if they own it; close (or a with block) unmaps it. '''
+    __slots__ = ('buffer', 'offsets', 'encoding', 'strip', 'source')
+
+    def __init__(self, buffer, offsets: array, encoding = 'utf-8', strip = True, source = None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.encoding = encoding
+        self.strip = strip      # whether lines end with a newline to be dropped
+        self.source = source
+
+    @classmethod
+    def from_file(cls, fp, encoding = 'utf-8'):
+        ''' Maps an open binary file. The line-offset index is read from, or persisted
+        to, a sibling .idx file when the file has a name on disk. '''
+        size = os.fstat(fp.fileno()).st_size
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        path = getattr(fp, 'name', None)
+        offsets = load_line_index(path) if isinstance(path, str) else None
+        if offsets is None:
+            offsets = index_lines(buffer)
+            if isinstance(path, str): save_line_index(path, offsets)
+        return cls(buffer, offsets, encoding, source=buffer if size else None)
+
+    def __len__(self): return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = _position(i, len(self))
+        line = bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]])
+        return (line.rstrip(b'\r\n') if self.strip else line).decode(self.encoding)
+
+    def __deepcopy__(self, memo):
+        return self         # read-only
+
+    def close(self):
+        ''' Releases the views over the mapped buffer, then unmaps it. The lines cannot be read afterwards. '''
+        for part in (self.buffer, self.offsets):
+            if isinstance(part, memoryview): part.release()
+        if self.source is not None:
+            self.source.close()
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+
+class MappedValues(MappedLines):
+    ''' MappedLines whose lines hold JSON values, decoded on access. '''
+    __slots__ = ()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return json.loads(super().__getitem__(i))
+
+
+def index_lines(buffer) -> array:
+    ''' Finds the offset of every line start in buffer. '''
+    offsets = array('Q', [0])
+    pos = buffer.find(b'\n')
+    while pos != -1:
+        offsets.append(pos + 1)
+        pos = buffer.find(b'\n', pos + 1)
+    if offsets[-1] != len(buffer):      # last line without a newline
+        offsets.append(len(buffer))
+    return offsets
+
+
+def _index_stamp(path):
+    stat = os.stat(path)
+    return array('Q', [stat.st_size, stat.st_mtime_ns])
+
+def load_line_index(path):
+    ''' Reads a persisted line index, or returns None if it is missing or stale. '''
+    try:
+        with open(path + INDEX_EXT, 'rb') as fp:
+            if fp.read(len(INDEX_MAGIC)) != INDEX_MAGIC: return None
+            stamp = array('Q')
+            stamp.frombytes(fp.read(stamp.itemsize * 2))
+            if stamp != _index_stamp(path): return None
+            offsets = array('Q')
+            offsets.frombytes(fp.read())
+            return offsets
+    except (OSError, ValueError):
+        return None
+
+def save_line_index(path, offsets: array):
+    try:
+        with open(path + INDEX_EXT, 'wb') as fp:
+            fp.write(INDEX_MAGIC)
+            fp.write(_index_stamp(path).tobytes())
+            fp.write(offsets.tobytes())
+    except OSError:
+        pass        # e.g. a read-only directory; the index is rebuilt next time
+
+
+ARTIFACT_MAGIC = b'XMTREC2\n'
+
+def write_artifact(fp, header: dict, lines, count: int, postings: dict = None):
+    ''' Writes a compiled recipe: magic, header length, a JSON header, then (8-byte aligned)
+    count + 1 line offsets, the UTF-8 lines themselves, back to back, and the search postings
+    as JSON, if any. Lines are written as they are if the header's 'values' is false, and as
+    JSON otherwise. The header (whose 'search' is set to the size of the postings) and the
+    postings are serialized before anything is written. '''
+    values = header.get('values', False)
+    section = json.dumps(postings).encode('utf-8') if postings is not None else b''
+    head = json.dumps({**header, 'search': len(section) if postings is not None else None}).encode('utf-8')
+    fp.write(ARTIFACT_MAGIC + struct.pack('<Q', len(head)) + head)
+    fp.write(b'\0' * (-fp.tell() % 8))
+
+    offsets_at = fp.tell()
+    fp.seek(8 * (count + 1), os.SEEK_CUR)      # filled in once the lines are written
+    offsets, pos = array('Q', [0]), 0
+    for line in lines:
+        data = (json.dumps(line) if values else line).encode('utf-8')
+        fp.write(data)
+        pos += len(data)
+        offsets.append(pos)
+    fp.write(section)
+    fp.seek(offsets_at)
+    fp.write(offsets.tobytes())
+
+
+def read_artifact(buffer):
+    ''' Reads a compiled recipe from a buffer (an mmap, typically) without copying the lines.
+    Returns the header and the lines as MappedLines (MappedValues for JSON lines), which
+    take over the buffer: closing them closes it. The postings, if any, follow the lines
+    in the lines' buffer (see SearchIndex.mapped). '''
+    if len(buffer) < len(ARTIFACT_MAGIC) + 8 or buffer[:len(ARTIFACT_MAGIC)] != ARTIFACT_MAGIC:
+        raise ValueError('Not a compiled recipe.')
+    pos = len(ARTIFACT_MAGIC)
+    head_len, = struct.unpack_from('<Q', buffer, pos)
+    pos += 8
+    header = json.loads(bytes(buffer[pos:pos + head_len]).decode('utf-8'))     # a ValueError if cut short
+    pos += head_len
+    pos += -pos % 8
+
+    count = header['count']
+    if len(buffer) < pos + 8 * (count + 1):
+        raise ValueError('Truncated compiled recipe.')
+    with memoryview(buffer) as view:
+        offsets = view[pos:pos + 8 * (count + 1)].cast('Q')
+        lines = view[pos + 8 * (count + 1):]
+    cls = MappedValues if header.get('values') else MappedLines
+    mapped = cls(lines, offsets, strip=False, source=buffer if hasattr(buffer, 'close') else None)
+    if len(lines) < offsets[-1] + (header.get('search') or 0):
+        mapped.close()
+        raise ValueError('Truncated compiled recipe.')
+    return header, mapped
+
+
+class LineColumn(Sequence):
+    ''' The content column: a concatenation of segments, each either a plain list
+    or a read-only sequence (such as MappedLines) that is shared, never copied. '''
+    __slots__ = ('segments', 'starts', '_len')
+
+    def __init__(self, lines = ()):
+        self.segments, self.starts, self._len = [], [], 0
+        self.extend(lines)
+
+    def __len__(self): return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = _position(i, len(self))
+        pos = bisect_right(self.starts, i) - 1
+        return self.segments[pos][i - self.starts[pos]]
+
+    def __iter__(self):
+        return chain.from_iterable(self.segments)
+
+    def __eq__(self, other):
+        return isinstance(other, (list, tuple, Sequence)) and list(self) == list(other)
+
+    def is_text(self):
+        ''' Whether every line is a str. Mapped segments are, unless they hold JSON values. '''
+        return all(not isinstance(segment, MappedValues) and
+                   (not isinstance(segment, list) or all(isinstance(line, str) for line in segment))
+                   for segment in self.segments)
+
+    def _tail(self):
+        if not self.segments or not isinstance(self.segments[-1], list):
+            self.starts.append(self._len)
+            self.segments.append([])
+        return self.segments[-1]
+
+    def append(self, line):
+        self._tail().append(line)
+        self._len += 1
+
+    def extend(self, lines):
+        for segment in (lines.segments if isinstance(lines, LineColumn) else [lines]):
+            if not len(segment):
+                continue
+            if isinstance(segment, list):
+                self._tail().extend(segment)
+                self._len += len(segment)
+            else:
+                self.starts.append(self._len)
+                self.segments.append(segment)
+                self._len += len(segment)
+
+
+class _Missing:
+    ''' The value of a column at a line that is not annotated with it; None is a value. '''
+    __slots__ = ()
+    def __bool__(self): return False
+    def __repr__(self): return 'MISSING'
+    def __reduce__(self): return 'MISSING'      # copies and pickles as the one instance
+
+MISSING = _Missing()
+
+
+class ContentStore:
+    ''' Column-oriented storage for the lines of a static recipe: one list holds the content,
+    and one per annotation holds its values (MISSING where a line is not annotated).
+    Annotation columns may be shorter than the content; the missing tail is unannotated. '''
+    __slots__ = ('columns', '_indexes', '_versions')
+
+    def __init__(self):
+        self.columns = {'content': LineColumn()}
+        self._indexes = {}      # lookup indexes over columns, built on first use
+        self._versions = {}     # column name -> count of the annotations it has taken
+
+    def __len__(self): return len(self.columns['content'])
+
+    def __iter__(self):
+        return (ContentWrapper(self, i) for i in range(len(self)))
+
+    def __getitem__(self, i):
+        return ContentWrapper(self, _position(i, len(self)))
+
+    def append(self, content):
+        self._indexes.clear()
+        self.columns['content'].append(content)
+
+    def extend_lines(self, lines):
+        ''' Appends unannotated lines; read-only sequences like MappedLines are not copied. '''
+        self._indexes.clear()
+        self.columns['content'].extend(lines)
+
+    def extend(self, other):
+        ''' Appends all lines of another store, with their annotations. '''
+        self._indexes.clear()
+        precount = len(self)
+        for name, column in other.columns.items():
+            if name == 'content':
+                self.columns['content'].extend(column)
+            elif column:
+                own = self.column(name)
+                own.extend([MISSING] * (precount - len(own)))
+                own.extend(column)
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = []
+        return self.columns[name]
+
+    def version(self, name):
+        ''' Changes whenever the values of a column, or the number of lines, do. '''
+        return len(self), self._versions.get(name, 0)
+
+    def annotate(self, name, i, value):
+        i = _position(i, len(self))
+        self._indexes.pop(name, None)
+        self._indexes.pop(('sorted', name), None)
+        self._versions[name] = self._versions.get(name, 0) + 1
+        column = self.column(name)
+        if i >= len(column):
+            column.extend([MISSING] * (i + 1 - len(column)))
+        column[i] = value
+
+    def value(self, name, i):
+        column = self.columns.get(name)
+        return column[i] if column is not None and i < len(column) else MISSING
+
+    def to_records(self):
+        return [row.to_dict() for row in self]
+
+    def value_index(self, name):
+        ''' value -> sorted 1-based indices of the lines with that value. Unhashable values are left out. '''
+        if name not in self._indexes:
+            index = {}
+            for i, value in enumerate(self.columns.get(name, ()), 1):
+                if value is not MISSING and getattr(value, '__hash__', None) is not None:
+                    index.setdefault(value, []).append(i)
+            self._indexes[name] = index
+        return self._indexes[name]
+
+    def sorted_index(self, name):
+        ''' The numeric values of a column in ascending order, with their 1-based indices. '''
+        key = ('sorted', name)
+        if key not in self._indexes:
+            pairs = sorted((value, i) for i, value in enumerate(self.columns.get(name, ()), 1)
+                           if isinstance(value, (int, float)) and not isinstance(value, bool))
+            self._indexes[key] = ([value for value, _ in pairs], [i for _, i in pairs])
+        return self._indexes[key]
+
+
+_TOKEN = re.compile(r'\w+')
+
+def tokenize(text):
+    return _TOKEN.findall(str(text).lower())
+
+
+class SearchIndex:
+    ''' An inverted index over the lines of a recipe: token -> sorted 1-based line indices.
+    Lines must be added in order. '''
+    __slots__ = ('_postings', '_section')
+
+    def __init__(self, postings = None):
+        self._postings = postings if postings is not None else {}
+        self._section = None    # (buffer, start, stop) of postings yet to be decoded
+
+    @classmethod
+    def mapped(cls, lines: MappedLines, size: int):
+        ''' The index stored after the lines of a compiled recipe; decoded on first use. '''
+        index = cls()
+        index._postings = None
+        index._section = (lines.buffer, lines.offsets[-1], lines.offsets[-1] + size)
+        return index
+
+    @property
+    def postings(self):
+        if self._postings is None:
+            buffer, start, stop = self._section
+            self._postings = json.loads(bytes(buffer[start:stop]).decode('utf-8'))
+            self._section = None
+        return self._postings
+
+    def add(self, i, text):
+        for token in set(tokenize(text)):
+            self.postings.setdefault(token, []).append(i)
+
+    def add_lines(self, start, lines):
+        for i, line in enumerate(lines, start):
+            self.add(i, line)
+
+    def extend(self, other, offset):
+        ''' Appends another index, for lines spliced in after offset. '''
+        for token, indices in other.postings.items():
+            self.postings.setdefault(token, []).extend(i + offset for i in indices)
+
+    def lookup(self, token):
+        return self.postings.get(token, [])
+
+
+def _position(i, total_len):
+    if i < 0: i += total_len
+    if not 0 <= i < total_len:
+        raise IndexError('Line index out of range.')
+    return i
+
+
+class ContentWrapper(Mapping):
+    ''' A read-only view of one line of a ContentStore, as a mapping of its annotations. '''
+    __slots__ = ('store', 'i')
+
+    def __init__(self, store: ContentStore, i: int):
+        self.store = store
+        self.i = i
+
+    def __getitem__(self, name):
+        value = self.store.value(name, self.i)
+        if value is MISSING: raise KeyError(name)
+        return value
+
+    def __iter__(self):
+        return (name for name in self.store.columns if self.store.value(name, self.i) is not MISSING)
+
+    def __len__(self): return sum(1 for _ in self)
     def __repr__(self): return self['content']
     def __str__(self): return self.__repr__()
     def __getattr__(self, name):
-        if name in self:
-            return self[name]
-        else:
-            try: return super().__getattr__(name)
-            except AttributeError: return ''
\ No newline at end of file
+        if name.startswith('__'): raise AttributeError(name)
+        value = self.store.value(name, self.i)
+        return '' if value is MISSING else value
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class ContentView(Sequence):
+    ''' A lazy sequence of lines, selected by 0-based positions (a range or a list),
+    or by 1-based indices (an IndexCollection, or a list with offset -1). '''
+    __slots__ = ('store', 'positions', 'offset')
+
+    def __init__(self, store: ContentStore, positions, offset = 0):
+        self.store = store
+        self.positions = positions
+        self.offset = offset
+
+    def __len__(self): return len(self.positions)
+
+    def __iter__(self):
+        return (ContentWrapper(self.store, i + self.offset) for i in self.positions)
+
+    def __getitem__(self, k):
+        positions = self.positions.indices if isinstance(self.positions, IndexCollection) else self.positions
+        if isinstance(k, slice):
+            return ContentView(self.store, positions[k], self.offset)
+        return ContentWrapper(self.store, positions[k] + self.offset)
+
+    def __repr__(self): return f'ContentView({len(self)} lines)'
@@ -1,4 +1,7 @@
 import os
+import mmap
+from collections import OrderedDict
+
 import yaml
 
 
@@ -9,42 +12,135 @@ class StorageException(Exception): pass
 class RecipeNotFoundException(StorageException): pass
 class CyclicDependencyException(StorageException): pass
 
+class RecipeCache:
+    ''' A bounded LRU cache of executed recipes, keyed by recipe name. Lookups are counted
+    by the caller (see record), once it knows whether the entry is current. '''
+    def __init__(self, maxsize = 64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        try:
+            self.entries.move_to_end(name)
+        except KeyError:
+            return None
+        return self.entries[name]
+
+    def record(self, outcome):
+        ''' Counts a lookup: 'hits' or 'misses'. '''
+        setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def put(self, name, value):
+        self.entries[name] = value
+        self.entries.move_to_end(name)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard(self, name):
+        self.entries.pop(name, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self): return len(self.entries)
+    def __contains__(self, name): return name in self.entries
+
+    def __deepcopy__(self, memo):
+        return RecipeCache(self.maxsize)    # cached executions are not part of the state
+
+
 class RecipeStorage:
     # make this an abstract class
-    def __init__(self):
-        pass
+    def __init__(self, cache_size = 64):
+        self.cache = RecipeCache(cache_size)
+        self.transport = None   # for http sources; None uses the shared default
+        self.http_cache = None  # for http sources with a cache option; likewise
+        self.singleflight = None    # a SingleFlight, to share one fetch among identical concurrent ones;
+                                    # None fetches every time (as random endpoints need)
+        self.rate_limiter = None    # a per-host limit on fetches; None means no limit
+        self.templates = None   # compiles the templates in var declarations; None uses the shared default
     def load_recipe(self, name) -> Spec:
         pass
     def load_resource(self, name):
         raise NotImplementedError
+    def version(self, name):
+        ''' A token that changes whenever the source of the named recipe does.
+        None means the version is unknown, and nothing gets cached. '''
+        return None
+    def resource_version(self, path):
+        ''' Like version, for a resource. '''
+        return None
+    def load_artifact(self, name):
+        ''' A buffer holding the compiled form of the named recipe, if there is a current one. '''
+        return None
 
     
 
+def _file_version(full):
+    # the real path, so the version does not depend on how the storage paths are spelled
+    stat = os.stat(full)
+    return (os.path.realpath(full), stat.st_mtime_ns, stat.st_size)
+
 class FileStorage(RecipeStorage):
     ''' A file-based storage that stores recipe specifications in files '''
-    def __init__(self, paths, append_ext = '.yaml', loader = yaml.safe_load, dumper = yaml.safe_dump):
+    ARTIFACT_EXT = '.xmtc'
+
+    def __init__(self, paths, append_ext = '.yaml', loader = yaml.safe_load, dumper = yaml.safe_dump,
+                 cache_size = 64):
         ''' Initialize a storage. loader/dumper specify the format (YAML by default)'''
+        super().__init__(cache_size)
         if isinstance(paths, str): paths = [paths]
         self.paths = paths
         self.loader = loader
         self.dumper = dumper
         self.append_ext = append_ext
     
-    def load_recipe(self, name) -> Spec:
+    def find_recipe(self, name) -> str:
         name += self.append_ext
         for path in self.paths:
             full = os.path.join(path, name)
-            if os.path.exists(full) and os.path.isfile(full): 
-                with open(full, 'r', encoding='utf-8') as fp:
-                    return self.loader(fp)
+            if os.path.exists(full) and os.path.isfile(full): return full
         raise RecipeNotFoundException(f'Could not find {name}.')
+
+    def load_recipe(self, name) -> Spec:
+        with open(self.find_recipe(name), 'r', encoding='utf-8') as fp:
+            return self.loader(fp)
+
+    def version(self, name):
+        try: return _file_version(self.find_recipe(name))
+        except RecipeNotFoundException: return None
+
+    def artifact_path(self, name) -> str:
+        ''' Where the compiled form of a recipe lives: next to its source. '''
+        full = self.find_recipe(name)
+        return full[:len(full) - len(self.append_ext)] + self.ARTIFACT_EXT
+
+    def load_artifact(self, name):
+        ''' Memory-maps the compiled form of the named recipe, if it is newer than the source. '''
+        try: path = self.artifact_path(name)
+        except RecipeNotFoundException: return None
+        if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(self.find_recipe(name)):
+            return None
+        if os.path.getsize(path) == 0:      # cannot be mapped, nor hold a recipe
+            return None
+        with open(path, 'rb') as fp:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
     
-    def load_resource(self, path, *args, **kwargs) -> str:
+    def find_resource(self, path) -> str:
         for parent_path in self.paths:
             full = os.path.join(parent_path, path)
-            if os.path.exists(full) and os.path.isfile(full): return open(full, *args, **kwargs)
+            if os.path.exists(full) and os.path.isfile(full): return full
         raise FileNotFoundError(f'Could not find {path}.')
 
+    def load_resource(self, path, *args, **kwargs):
+        return open(self.find_resource(path), *args, **kwargs)
+
+    def resource_version(self, path):
+        try: return _file_version(self.find_resource(path))
+        except FileNotFoundError: return None
+
     def write(self, name, spec):
         with open(name, 'w', encoding='utf-8') as fp:
             self.dumper(spec, fp)
@@ -55,9 +151,18 @@ class FileStorage(RecipeStorage):
 
 class MemoryStorage(RecipeStorage, dict):
     ''' A memory-storage that stores recipe specifications directly '''
-    def __init__(self, **data):
-        super().__init__(**data)
+    def __init__(self, cache_size = 64, **data):
+        RecipeStorage.__init__(self, cache_size)
+        self._writes = {}       # name -> times written; specs changed in place must be written again
+        dict.__init__(self, **data)
+    def __setitem__(self, name, spec):
+        dict.__setitem__(self, name, spec)
+        self._writes[name] = self._writes.get(name, 0) + 1
+    def update(self, *args, **kwargs):
+        for name, spec in dict(*args, **kwargs).items(): self[name] = spec
     def load_recipe(self, name) -> Spec:
         try: return self[name]
         except KeyError: raise RecipeNotFoundException(f'Could not find {name}.')
+    def version(self, name):
+        return self._writes.get(name, 0) if name in self else None
     def write(self, name, spec: Spec): self[name] = spec
\ No newline at end of file